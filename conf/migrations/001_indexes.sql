@@ -0,0 +1,20 @@
+-- Secondary indexes for the lookups made while analysing, editing and exporting reports
+
+CREATE INDEX if not exists idx_attack_uids_tid ON attack_uids(tid);
+CREATE INDEX if not exists idx_attack_uids_name ON attack_uids(name);
+
+CREATE INDEX if not exists idx_true_positives_uid ON true_positives(uid);
+CREATE INDEX if not exists idx_true_positives_sentence_id ON true_positives(sentence_id);
+CREATE INDEX if not exists idx_false_positives_uid ON false_positives(uid);
+CREATE INDEX if not exists idx_false_positives_sentence_id ON false_positives(sentence_id);
+CREATE INDEX if not exists idx_false_negatives_uid ON false_negatives(uid);
+CREATE INDEX if not exists idx_false_negatives_sentence_id ON false_negatives(sentence_id);
+
+CREATE INDEX if not exists idx_reports_title ON reports(title);
+CREATE INDEX if not exists idx_reports_current_status ON reports(current_status);
+CREATE INDEX if not exists idx_report_sentences_report_uid ON report_sentences(report_uid);
+CREATE INDEX if not exists idx_report_sentence_hits_uid ON report_sentence_hits(uid);
+CREATE INDEX if not exists idx_report_sentence_hits_report_uid ON report_sentence_hits(report_uid);
+CREATE INDEX if not exists idx_original_html_report_uid ON original_html(report_uid);
+
+ANALYZE;
@@ -0,0 +1,43 @@
+-- Full-text indexes over report sentences and the labelled examples, kept in sync by triggers
+
+CREATE VIRTUAL TABLE if not exists report_sentences_fts USING fts5(text, content='report_sentences', content_rowid='uid');
+CREATE VIRTUAL TABLE if not exists true_positives_fts USING fts5(true_positive, content='true_positives', content_rowid='rowid');
+CREATE VIRTUAL TABLE if not exists false_positives_fts USING fts5(false_positive, content='false_positives', content_rowid='rowid');
+
+CREATE TRIGGER if not exists report_sentences_fts_insert AFTER INSERT ON report_sentences BEGIN
+    INSERT INTO report_sentences_fts(rowid, text) VALUES (new.uid, new.text);
+END;
+CREATE TRIGGER if not exists report_sentences_fts_delete AFTER DELETE ON report_sentences BEGIN
+    INSERT INTO report_sentences_fts(report_sentences_fts, rowid, text) VALUES ('delete', old.uid, old.text);
+END;
+CREATE TRIGGER if not exists report_sentences_fts_update AFTER UPDATE OF text ON report_sentences BEGIN
+    INSERT INTO report_sentences_fts(report_sentences_fts, rowid, text) VALUES ('delete', old.uid, old.text);
+    INSERT INTO report_sentences_fts(rowid, text) VALUES (new.uid, new.text);
+END;
+
+CREATE TRIGGER if not exists true_positives_fts_insert AFTER INSERT ON true_positives BEGIN
+    INSERT INTO true_positives_fts(rowid, true_positive) VALUES (new.rowid, new.true_positive);
+END;
+CREATE TRIGGER if not exists true_positives_fts_delete AFTER DELETE ON true_positives BEGIN
+    INSERT INTO true_positives_fts(true_positives_fts, rowid, true_positive) VALUES ('delete', old.rowid, old.true_positive);
+END;
+CREATE TRIGGER if not exists true_positives_fts_update AFTER UPDATE OF true_positive ON true_positives BEGIN
+    INSERT INTO true_positives_fts(true_positives_fts, rowid, true_positive) VALUES ('delete', old.rowid, old.true_positive);
+    INSERT INTO true_positives_fts(rowid, true_positive) VALUES (new.rowid, new.true_positive);
+END;
+
+CREATE TRIGGER if not exists false_positives_fts_insert AFTER INSERT ON false_positives BEGIN
+    INSERT INTO false_positives_fts(rowid, false_positive) VALUES (new.rowid, new.false_positive);
+END;
+CREATE TRIGGER if not exists false_positives_fts_delete AFTER DELETE ON false_positives BEGIN
+    INSERT INTO false_positives_fts(false_positives_fts, rowid, false_positive) VALUES ('delete', old.rowid, old.false_positive);
+END;
+CREATE TRIGGER if not exists false_positives_fts_update AFTER UPDATE OF false_positive ON false_positives BEGIN
+    INSERT INTO false_positives_fts(false_positives_fts, rowid, false_positive) VALUES ('delete', old.rowid, old.false_positive);
+    INSERT INTO false_positives_fts(rowid, false_positive) VALUES (new.rowid, new.false_positive);
+END;
+
+-- index whatever the database already holds
+INSERT INTO report_sentences_fts(report_sentences_fts) VALUES ('rebuild');
+INSERT INTO true_positives_fts(true_positives_fts) VALUES ('rebuild');
+INSERT INTO false_positives_fts(false_positives_fts) VALUES ('rebuild');
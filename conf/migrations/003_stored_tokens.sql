@@ -0,0 +1,11 @@
+-- Tokenized form of every labelled text, stamped with the tokenizer version that produced it.
+-- Existing rows are left NULL here and filled in by DataService.backfill_tokens at startup.
+
+ALTER TABLE true_positives ADD COLUMN tokens TEXT;
+ALTER TABLE true_positives ADD COLUMN token_version INTEGER;
+ALTER TABLE false_positives ADD COLUMN tokens TEXT;
+ALTER TABLE false_positives ADD COLUMN token_version INTEGER;
+ALTER TABLE false_negatives ADD COLUMN tokens TEXT;
+ALTER TABLE false_negatives ADD COLUMN token_version INTEGER;
+ALTER TABLE true_negatives ADD COLUMN tokens TEXT;
+ALTER TABLE true_negatives ADD COLUMN token_version INTEGER;
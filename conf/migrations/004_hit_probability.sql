@@ -0,0 +1,3 @@
+-- Probability the classifier gave an ML hit, NULL for regex hits and analyst-added techniques
+
+ALTER TABLE report_sentence_hits ADD COLUMN probability REAL;
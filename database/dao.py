@@ -4,13 +4,22 @@ import logging
 
 class Dao:
 
-    def __init__(self, database):
+    def __init__(self, database, pool_size=4):
         self.logger = logging.getLogger('DataService')
-        self.db = Attack(database)
+        self.db = Attack(database, pool_size=pool_size)
+
+    async def close(self):
+        await self.db.close()
 
     async def build(self, schema):
         await self.db.build(schema)
 
+    async def compact(self):
+        return await self.db.compact()
+
+    async def apply_migration(self, version, name, script):
+        await self.db.apply_migration(version, name, script)
+
     async def get(self, table, criteria=None):
         return await self.db.get(table, criteria)
 
@@ -20,11 +29,20 @@ class Dao:
     async def insert(self, table, data):
         return await self.db.insert(table, data)
 
+    async def insert_many(self, table, rows):
+        return await self.db.insert_many(table, rows)
+
+    def transaction(self):
+        return self.db.transaction()
+
     async def delete(self, table, data):
         await self.db.delete(table, data)
 
     async def raw_query(self, query, one=False):
         return await self.db.raw_query(query, one)
         
-    async def raw_select(self, query):
-        return await self.db.raw_select(query)
\ No newline at end of file
+    async def raw_select(self, query, parameters=()):
+        return await self.db.raw_select(query, parameters)
+
+    async def raw_update(self, query):
+        await self.db.raw_update(query)
@@ -1,86 +1,395 @@
+import asyncio
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
 
 class Attack:
 
-    def __init__(self, database):
+    def __init__(self, database, pool_size=4):
         self.database = database
+        self.pool_size = max(1, int(pool_size))
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='tram-db')
+        self._connections = []
+        self._opened = 0
+        self._idle = None
+        self._write_lock = None
+        self.query = QueryBuilder()
+
+    def _connect(self):
+        """Open a connection configured for concurrent readers and a single writer"""
+        conn = sqlite3.connect(self.database, timeout=30, check_same_thread=False, cached_statements=256)
+        # only takes effect on a new database, and has to come before anything writes the file header. Setting it
+        # takes the write lock, so leave existing databases alone rather than wait on whoever is writing
+        if not conn.execute('PRAGMA page_count').fetchone()[0]:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -16000')
+        return conn
+
+    def _prepare(self):
+        # created on first use, so they belong to the loop the server runs on
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            self._write_lock = asyncio.Lock()
+
+    async def _acquire(self):
+        self._prepare()
+        if self._idle.empty() and self._opened < self.pool_size:
+            # claim the slot before the await, or concurrent callers would all see room for one more
+            self._opened += 1
+            future = asyncio.get_event_loop().run_in_executor(self._executor, self._connect)
+            try:
+                conn = await _settle(future)
+            except BaseException:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    # cancelled while connecting, so keep the connection for the next caller
+                    self._connections.append(future.result())
+                    self._release(future.result())
+                else:
+                    self._opened -= 1
+                raise
+            self._connections.append(conn)
+            return conn
+        return await self._idle.get()
+
+    def _release(self, conn):
+        self._idle.put_nowait(conn)
+
+    async def _run(self, func, *args, write=False):
+        """
+        Run a blocking statement function on a pooled connection in the executor
+        :param func: Callable taking the connection as its first argument
+        :param write: Serialize with other writers, as SQLite only allows one at a time
+        :return: The callable's return value
+        """
+        loop = asyncio.get_event_loop()
+        if write:
+            # take the lock before the connection, so writers waiting their turn do not hold connections readers need
+            self._prepare()
+            async with self._write_lock:
+                conn = await self._acquire()
+                try:
+                    return await _settle(loop.run_in_executor(self._executor, _autocommit, func, conn, *args))
+                finally:
+                    self._release(conn)
+        conn = await self._acquire()
+        try:
+            return await _settle(loop.run_in_executor(self._executor, func, conn, *args))
+        finally:
+            self._release(conn)
+
+    async def _ensure_schema(self):
+        if self.query.tables is None:
+            self.query.tables = await self._run(_load_schema)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Unit of work holding one connection and the write lock until the block exits
+        :return: Transaction which commits on success and rolls back if the block raises
+        """
+        loop = asyncio.get_event_loop()
+        self._prepare()
+        async with self._write_lock:
+            conn = await self._acquire()
+            try:
+                await _settle(loop.run_in_executor(self._executor, conn.execute, 'BEGIN IMMEDIATE'))
+                try:
+                    yield Transaction(self, conn)
+                except BaseException:
+                    await _settle(loop.run_in_executor(self._executor, conn.rollback))
+                    raise
+                await _settle(loop.run_in_executor(self._executor, conn.commit))
+            finally:
+                self._release(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+        self._opened = 0
+        self._idle = None
+        self._executor.shutdown(wait=False)
 
     async def build(self, schema):
         try:
-            with sqlite3.connect(self.database) as conn:
-                cursor = conn.cursor()
-                cursor.executescript(schema)
-                conn.commit()
+            await self._run(_build, schema, write=True)
         except Exception as exc:
             print('! error building db : {}'.format(exc))
+        self.query.tables = None
+
+    async def compact(self):
+        return await self._run(_compact, write=True)
+
+    async def apply_migration(self, version, name, script):
+        try:
+            await self._run(_apply_migration, version, name, script, write=True)
+        finally:
+            self.query.tables = None
 
     async def get(self, table, criteria=None):
-        with sqlite3.connect(self.database) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            sql = 'SELECT * FROM %s ' % table
-            if criteria:
-                where = next(iter(criteria))
-                value = criteria.pop(where)
-                if value:
-                    sql += (' WHERE %s = "%s"' % (where, value))
-                    for k, v in criteria.items():
-                        sql += (' AND %s = "%s"' % (k, v))
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            return [dict(ix) for ix in rows]
+        await self._ensure_schema()
+        return await self._run(_select, *self.query.select(table, criteria))
 
     async def insert(self, table, data):
-        with sqlite3.connect(self.database) as conn:
-            cursor = conn.cursor()
-            columns = ', '.join(data.keys())
-            temp = ['?' for i in range(len(data.values()))]
-            placeholders = ', '.join(temp)
-            sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, columns, placeholders)
-            cursor.execute(sql, tuple(data.values()))
-            id = cursor.lastrowid
-            conn.commit()
-            return id
+        await self._ensure_schema()
+        return await self._run(_insert, self.query.insert(table, data), tuple(data.values()), write=True)
+
+    async def insert_many(self, table, rows):
+        if not rows:
+            return []
+        await self._ensure_schema()
+        return await self._run(_insert_many, self.query.insert(table, rows[0]), _row_values(rows), write=True)
 
     async def update(self, table, key, value, data):
-        with sqlite3.connect(self.database) as conn:
-            cursor = conn.cursor()
-            for k, v in data.items():
-                sql = 'UPDATE {} SET {} = (?) WHERE {} = "{}"'.format(table, k, key, value)
-                cursor.execute(sql, (v,))
-            conn.commit()
+        await self._ensure_schema()
+        await self._run(_execute, [self.query.update(table, key, value, data)], write=True)
 
     async def delete(self, table, data):
-        with sqlite3.connect(self.database) as conn:
-            cursor = conn.cursor()
-            sql = 'DELETE FROM %s ' % table
-            where = next(iter(data))
-            value = data.pop(where)
-            sql += (' WHERE %s = "%s"' % (where, value))
-            for k, v in data.items():
-                sql += (' AND %s = "%s"' % (k, v))
-            cursor.execute(sql)
-            conn.commit()
+        await self._ensure_schema()
+        await self._run(_execute, [self.query.delete(table, data)], write=True)
 
     async def raw_query(self, query, one=False):
-        with sqlite3.connect(self.database) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            rv = cursor.fetchall()
-            conn.commit()
-            return rv[0] if rv else None if one else rv
-
-    async def raw_select(self, sql):
-        with sqlite3.connect(self.database) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            return [dict(ix) for ix in rows]
+        rv = await self._run(_raw_query, query, write=True)
+        self.query.tables = None
+        return rv[0] if rv else None if one else rv
+
+    async def raw_select(self, sql, parameters=()):
+        return await self._run(_select, sql, parameters)
 
     async def raw_update(self, sql):
-        with sqlite3.connect(self.database) as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql)
-            conn.commit()
\ No newline at end of file
+        await self._run(_execute, [(sql, ())], write=True)
+        self.query.tables = None
+
+
+class Transaction:
+
+    def __init__(self, attack, conn):
+        self.attack = attack
+        self.conn = conn
+        self.query = attack.query
+
+    async def _run(self, func, *args):
+        return await _settle(asyncio.get_event_loop().run_in_executor(self.attack._executor, func, self.conn, *args))
+
+    async def _ensure_schema(self):
+        # load through this transaction's connection, as the pool may have none left to spare
+        if self.query.tables is None:
+            self.query.tables = await self._run(_load_schema)
+
+    async def get(self, table, criteria=None):
+        await self._ensure_schema()
+        return await self._run(_select, *self.query.select(table, criteria))
+
+    async def insert(self, table, data):
+        await self._ensure_schema()
+        return await self._run(_insert, self.query.insert(table, data), tuple(data.values()))
+
+    async def insert_many(self, table, rows):
+        if not rows:
+            return []
+        await self._ensure_schema()
+        return await self._run(_insert_many, self.query.insert(table, rows[0]), _row_values(rows))
+
+    async def update(self, table, key, value, data):
+        await self._ensure_schema()
+        await self._run(_execute, [self.query.update(table, key, value, data)])
+
+    async def delete(self, table, data):
+        await self._ensure_schema()
+        await self._run(_execute, [self.query.delete(table, data)])
+
+    async def execute(self, sql, parameters=()):
+        await self._run(_execute, [(sql, parameters)])
+
+    async def execute_many(self, sql, rows):
+        await self._run(_execute, [(sql, parameters) for parameters in rows])
+
+
+class QueryBuilder:
+    """
+    Builds placeholder-bound statements for the get/insert/update/delete helpers. Table and column names are
+    checked against the database's own schema, and a criteria value that is a list, tuple or set becomes an
+    IN list while None becomes IS NULL. SQL text is cached per statement shape, so repeated lookups hand
+    SQLite identical text and reuse the connection's prepared statement.
+    """
+
+    def __init__(self):
+        self.tables = None
+
+    def select(self, table, criteria=None):
+        shape, parameters = self._criteria(table, criteria)
+        return _select_sql(table, shape), tuple(parameters)
+
+    def insert(self, table, data):
+        columns = tuple(data)
+        self._check(table, columns)
+        return _insert_sql(table, columns)
+
+    def update(self, table, key, value, data):
+        columns = tuple(data)
+        self._check(table, columns + (key,))
+        return _update_sql(table, columns, key), tuple(data.values()) + (value,)
+
+    def delete(self, table, criteria):
+        shape, parameters = self._criteria(table, criteria)
+        return _delete_sql(table, shape), tuple(parameters)
+
+    def _criteria(self, table, criteria):
+        shape, parameters = [], []
+        for column, value in (criteria or {}).items():
+            if value is None:
+                shape.append((column, None))
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                shape.append((column, len(value)))
+                parameters.extend(value)
+            else:
+                shape.append((column, '='))
+                parameters.append(value)
+        self._check(table, [column for column, _ in shape])
+        return tuple(shape), parameters
+
+    def _check(self, table, columns):
+        if table not in self.tables:
+            raise ValueError('Unknown table: {}'.format(table))
+        for column in columns:
+            if column not in self.tables[table]:
+                raise ValueError('Unknown column: {}.{}'.format(table, column))
+
+
+def _where(shape):
+    clauses = []
+    for column, size in shape:
+        if size is None:
+            clauses.append('{} IS NULL'.format(column))
+        elif size == '=':
+            clauses.append('{} = ?'.format(column))
+        else:
+            clauses.append('{} IN ({})'.format(column, ', '.join(['?'] * size)))
+    return ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+
+@lru_cache(maxsize=512)
+def _select_sql(table, shape):
+    return 'SELECT * FROM {}{}'.format(table, _where(shape))
+
+
+@lru_cache(maxsize=512)
+def _insert_sql(table, columns):
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+
+
+@lru_cache(maxsize=512)
+def _update_sql(table, columns, key):
+    return 'UPDATE {} SET {} WHERE {} = ?'.format(table, ', '.join('{} = ?'.format(c) for c in columns), key)
+
+
+@lru_cache(maxsize=512)
+def _delete_sql(table, shape):
+    return 'DELETE FROM {}{}'.format(table, _where(shape))
+
+
+async def _settle(future):
+    """
+    Await an executor future. Cancelling the awaiting task does not stop the statement running on the executor
+    thread, so wait for it to finish before letting the cancellation through. Otherwise the connection could be
+    rolled back, committed by its next user or handed out again while the statement is still running on it.
+    """
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError as cancelled:
+        while not future.done():
+            try:
+                await asyncio.wait((future,))
+            except asyncio.CancelledError:
+                pass
+        raise cancelled
+
+
+def _load_schema(conn):
+    tables = {}
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')").fetchall():
+        tables[name] = {row[1] for row in conn.execute('PRAGMA table_info("{}")'.format(name.replace('"', '""')))}
+    return tables
+
+
+def _autocommit(func, conn, *args):
+    with conn:
+        return func(conn, *args)
+
+
+def _build(conn, schema):
+    conn.executescript(schema)
+    conn.commit()
+    # the schema switches foreign keys on, which used to last only for the throwaway build connection
+    conn.execute('PRAGMA foreign_keys = OFF')
+
+
+def _compact(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    pages_before = conn.execute('PRAGMA page_count').fetchone()[0]
+    # incremental vacuum needs auto_vacuum set, which an existing database only picks up through a full VACUUM
+    vacuumed = conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2
+    if vacuumed:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    else:
+        # each step of the pragma frees one page, and only executescript steps it to completion
+        conn.executescript('PRAGMA incremental_vacuum;')
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    pages_after = conn.execute('PRAGMA page_count').fetchone()[0]
+    return dict(vacuumed=vacuumed, bytes_before=pages_before * page_size, bytes_after=pages_after * page_size)
+
+
+def _apply_migration(conn, version, name, script):
+    # executescript commits anything pending first, so open the transaction inside the script itself
+    conn.executescript('BEGIN;\n' + script)
+    conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+
+
+def _select(conn, sql, parameters=()):
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute(sql, parameters)
+    return [dict(ix) for ix in cursor.fetchall()]
+
+
+def _insert(conn, sql, parameters):
+    return conn.execute(sql, parameters).lastrowid
+
+
+def _row_values(rows):
+    """
+    :return: each row's values in the column order of the first row, which the insert statement is built from
+    """
+    columns = rows[0].keys()
+    values = []
+    for row in rows:
+        if row.keys() != columns:
+            raise ValueError('Row columns {} do not match {}'.format(sorted(row), sorted(columns)))
+        values.append(tuple(row[column] for column in columns))
+    return values
+
+
+def _insert_many(conn, sql, rows):
+    # executemany does not report the generated keys, so reuse the one prepared statement per row instead
+    cursor = conn.cursor()
+    ids = []
+    for parameters in rows:
+        cursor.execute(sql, parameters)
+        ids.append(cursor.lastrowid)
+    return ids
+
+
+def _execute(conn, statements):
+    for sql, parameters in statements:
+        conn.execute(sql, parameters)
+
+
+def _raw_query(conn, sql):
+    return conn.execute(sql).fetchall()
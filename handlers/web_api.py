@@ -1,6 +1,20 @@
 from aiohttp_jinja2 import template, web
+import asyncio
+import logging
+import time
 import nltk
 import json
+from urllib.parse import urlencode
+
+from service.data_svc import REPORT_STATUSES
+
+
+def _query_int(request, name, default=None, minimum=0):
+    """:return: the query parameter as an int no lower than minimum, or default when it is missing or not a number"""
+    try:
+        return max(minimum, int(request.query[name]))
+    except (KeyError, ValueError):
+        return default
 
 
 class WebAPI:
@@ -21,11 +35,31 @@ class WebAPI:
 
     @template('index.html')
     async def index(self, request):
-        index = dict(needs_review=await self.data_svc.status_grouper("needs_review"))
-        index['queue'] = await self.data_svc.status_grouper("queue")
-        index['in_review'] = await self.data_svc.status_grouper("in_review")
-        index['completed'] = await self.data_svc.status_grouper("completed")
-        return index
+        # columns are paged when a page_size is given, e.g. /?page_size=50&completed_page=2
+        page_size = _query_int(request, 'page_size', minimum=1)
+        pages = {status: _query_int(request, '{}_page'.format(status), default=0) for status in REPORT_STATUSES}
+        board = await self.data_svc.report_board(page_size=page_size, pages=pages)
+        board['paging'] = {status: self._paging(board, status, page_size) for status in REPORT_STATUSES}
+        return board
+
+    @staticmethod
+    def _paging(board, status, page_size):
+        """:return: a column's report count, its page and page count, and links to the pages either side of it"""
+        count = board['{}_count'.format(status)]
+        page = board.get('{}_page'.format(status), 0)
+        paging = dict(count=count, page=page, pages=1, previous=None, next=None)
+        if not page_size:
+            return paging
+        paging['pages'] = max(1, -(-count // page_size))
+        # keep every other column on the page it is showing
+        query = dict(page_size=page_size)
+        query.update(('{}_page'.format(other), board.get('{}_page'.format(other), 0)) for other in REPORT_STATUSES
+                     if other != status and board.get('{}_page'.format(other)))
+        if page > 0:
+            paging['previous'] = '/?' + urlencode(dict(query, **{'{}_page'.format(status): page - 1}))
+        if page + 1 < paging['pages']:
+            paging['next'] = '/?' + urlencode(dict(query, **{'{}_page'.format(status): page + 1}))
+        return paging
 
     async def rest_api(self, request):
         """
@@ -47,7 +81,15 @@ class WebAPI:
                 delete_report=lambda d: self.rest_svc.delete_report(criteria=d),
                 sentence_context=lambda d: self.rest_svc.sentence_context(criteria=d),
                 confirmed_sentences=lambda d: self.rest_svc.confirmed_sentences(criteria=d),
-                missing_technique=lambda d: self.rest_svc.missing_technique(criteria=d)
+                missing_technique=lambda d: self.rest_svc.missing_technique(criteria=d),
+                search=lambda d: self.rest_svc.search(criteria=d),
+                compact_database=lambda d: self.rest_svc.compact_database(criteria=d),
+                build_status=lambda d: self.rest_svc.build_status(criteria=d),
+                model_version=lambda d: self.rest_svc.model_version(criteria=d),
+                insert_regex_pattern=lambda d: self.rest_svc.insert_regex_pattern(criteria=d),
+                regex_profile=lambda d: self.rest_svc.regex_profile(criteria=d),
+                cancel_analysis=lambda d: self.rest_svc.cancel_analysis(criteria=d),
+                queue_status=lambda d: self.rest_svc.queue_status(criteria=d)
             ))
         output = await options[request.method][index](data)
         return web.json_response(output)
@@ -61,7 +103,7 @@ class WebAPI:
         """
         report = await self.dao.get('reports', dict(title=request.match_info.get('file')))
         sentences = await self.data_svc.build_sentences(report[0]['uid'])
-        attack_uids = await self.dao.get('attack_uids')
+        attack_uids = await self.data_svc.get_techniques()
         original_html = await self.dao.get('original_html', dict(report_uid=report[0]['uid']))
         final_html = await self.web_svc.build_final_html(original_html, sentences)
         return dict(file=request.match_info.get('file'), title=report[0]['title'], sentences=sentences, attack_uids=attack_uids, original_html=original_html, final_html=final_html)
@@ -120,7 +162,6 @@ class WebAPI:
         # Get the report
         report = await self.dao.get('reports', dict(title=request.match_info.get('file')))
         sentences = await self.data_svc.build_sentences(report[0]['uid'])
-        attack_uids = await self.dao.get('attack_uids')
 
         dd = dict()
         dd['content'] = []
@@ -138,15 +179,10 @@ class WebAPI:
         # Add the text to the document
         for sentence in sentences:
             dd['content'].append(sentence['text'])
-            if sentence['hits']:
-                for hit in sentence['hits']:
-                    # 'hits' object doesn't provide all the information we need, so we
-                    # do a makeshift join here to get that information from the attack_uid
-                    # list. This is ineffecient, and a way to improve this would be to perform
-                    # a join on the database side
-                    matching_attacks = [i for i in attack_uids if hit['attack_uid'] == i['uid']]
-                    for match in matching_attacks:
-                        table["body"].append([match["tid"], match["name"], sentence['text']])
+            for hit in sentence['hits']:
+                # hits are joined with attack_uids when loaded; skip any whose technique no longer exists
+                if hit['technique_tid'] is not None:
+                    table["body"].append([hit["technique_tid"], hit["technique_name"], sentence['text']])
 
         # Append table to the end
         dd['content'].append({"table": table})
@@ -154,43 +190,23 @@ class WebAPI:
 
     async def rebuild_ml(self, request):
         """
-        This is a new api function to force a rebuild of the ML models. This is intended to be kicked off in the background at some point
-        :param request: uh, nothing?
+        Function to rebuild the ML models in the background, poll the build_status rest action for progress
+        :param request: only the techniques with new training data are retrained, unless ?full=1 is given
         :return: status of rebuild
         """
-        # get techniques from database
-        tech_data = await self.dao.get('attack_uids')
-        techniques = {}
-        for row in tech_data:
-            # skip software for now
-            if 'tool' in row['tid'] or 'malware' in row['tid']:
-                continue
-            else:
-                # query for true positives
-                true_pos = await self.dao.get('true_positives', dict(uid=row['uid']))
-                tp = []
-                for t in true_pos:
-                    tp.append(t['true_positive'])
-                # query for false negatives and false positives
-                false_neg = await self.dao.get('false_negatives', dict(uid=row['uid']))
-                false_positives = await self.dao.get('false_positives', dict(uid=row['uid']))
-                for f in false_neg:
-                    tp.append(f['false_negative'])
-                fp = []
-                for fps in false_positives:
-                    fp.append(fps['false_positive'])
-
-                techniques[row['uid']] = {'id': row['tid'], 'name': row['name'], 'similar_words': [],
-                                          'example_uses': tp, 'false_positives': fp}
-
-        # query for true negatives
-        true_negatives = []
-        true_negs = await self.dao.get('true_negatives')
-        for i in true_negs:
-            true_negatives.append(i['sentence'])
-        list_of_legacy, list_of_techs = await self.data_svc.ml_reg_split(techniques)
-        self.ml_svc.build_pickle_file(self, list_of_techs, techniques, true_negatives, force=True)
-
-        return {'text': 'ML Rebuilt!'}
-
+        if self.ml_svc.build_status['state'] == 'building':
+            return web.json_response(dict(text='ML rebuild already running'))
+        # claim the build before the task gets to run, so a second request straight after this one is turned away
+        self.ml_svc.build_status.update(state='building', started=time.time(), finished=None)
+        asyncio.create_task(self._rebuild_ml(full=request.query.get('full') in ('1', 'true')))
+        return web.json_response(dict(text='ML rebuild started'))
+
+    async def _rebuild_ml(self, full=False):
+        # get techniques from database, analyses pick up the new models once they are built
+        try:
+            techniques = await self.data_svc.get_training_techniques()
+            await self.ml_svc.load_resident(techniques=techniques, force=True, full=full)
+        except Exception:
+            logging.exception('[!] ML rebuild failed')
+            self.ml_svc.build_status.update(state='failed', finished=time.time())
 
@@ -1,26 +1,37 @@
+import os
 import re
 import json
+import time
+import asyncio
 import logging
 from taxii2client import Collection
 from stix2 import TAXIICollectionSource, Filter
 
+from service.web_svc import TOKENIZER_VERSION
 
-def defang_text(text):
-    """
-    Function to normalize quoted data to be sql compliant
-    :param text: Text to be defang'd
-    :return: Defang'd text
-    """
-    text = text.replace("'", "''")
-    text = text.replace('"', '""')
-    return text
+
+REPORT_STATUSES = ('queue', 'needs_review', 'in_review', 'completed')
+# labelled tables and their text column, each also storing the text's tokens and the tokenizer version
+LABELLED_TEXT = (('true_positives', 'true_positive'), ('false_positives', 'false_positive'),
+                 ('false_negatives', 'false_negative'), ('true_negatives', 'sentence'))
+
+
+def _names(software):
+    """:return: a software object's name followed by any aliases it is also known by"""
+    names = [software['name']]
+    names.extend(alias for alias in software.get('x_mitre_aliases', []) if alias not in names)
+    return names
 
 
 class DataService:
 
-    def __init__(self, dao, web_svc):
+    def __init__(self, dao, web_svc, board_cache_ttl=5):
         self.dao = dao
         self.web_svc = web_svc
+        self.technique_index = None
+        self.board_cache_ttl = board_cache_ttl
+        self.board_cache = None
+        self.catalog_listeners = []
 
     async def reload_database(self, schema='conf/schema.sql'):
         """
@@ -30,6 +41,28 @@ class DataService:
         """
         with open(schema) as schema:
             await self.dao.build((schema.read()))
+        await self.migrate_database()
+        self.catalog_changed()
+
+    async def migrate_database(self, migrations='conf/migrations'):
+        """
+        Function to upgrade the database in place by applying any migration scripts it has not seen yet
+        :param migrations: Directory of migration scripts named <version>_<description>.sql
+        :return: list of the versions applied
+        """
+        await self.dao.build('CREATE TABLE if not exists schema_version (version INTEGER PRIMARY KEY, name TEXT, '
+                             'applied_on TEXT DEFAULT CURRENT_TIMESTAMP);')
+        current = {row['version'] for row in await self.dao.get('schema_version')}
+        pending = []
+        for file_name in os.listdir(migrations):
+            version, _, name = file_name.partition('_')
+            if file_name.endswith('.sql') and version.isdigit() and int(version) not in current:
+                pending.append((int(version), file_name))
+        for version, file_name in sorted(pending):
+            logging.info('[#] Applying database migration {}'.format(file_name))
+            with open(os.path.join(migrations, file_name)) as script:
+                await self.dao.apply_migration(version, file_name, script.read())
+        return [version for version, _ in sorted(pending)]
 
     async def insert_attack_stix_data(self):
         """
@@ -79,10 +112,10 @@ class DataService:
                 continue
             else:
                 references[i["id"]] = {"id": i['id'], "name": i["name"], "description": i["description"],
-                                       "examples": [], "example_uses": [], "similar_words": [i["name"]]}
+                                       "examples": [], "example_uses": [], "similar_words": _names(i)}
         for i in attack["tools"]:
             references[i["id"]] = {"id": i['id'], "name": i["name"], "description": i["description"], "examples": [],
-                                   "example_uses": [], "similar_words": [i["name"]]}
+                                   "example_uses": [], "similar_words": _names(i)}
 
         attack_data = references
         logging.info("Finished...now creating the database.")
@@ -91,26 +124,23 @@ class DataService:
         cur_items = [i['uid'] for i in cur_uids]
         for k, v in attack_data.items():
             if k not in cur_items:
-                await self.dao.insert('attack_uids', dict(uid=k, description=defang_text(v['description']), tid=v['id'],
+                await self.dao.insert('attack_uids', dict(uid=k, description=v['description'], tid=v['id'],
                                                           name=v['name']))
                 if 'regex_patterns' in v:
-                    [await self.dao.insert('regex_patterns', dict(uid=k, regex_pattern=defang_text(x))) for x in
+                    [await self.dao.insert('regex_patterns', dict(attack_uid=k, regex_pattern=x)) for x in
                      v['regex_patterns']]
                 if 'similar_words' in v:
-                    [await self.dao.insert('similar_words', dict(uid=k, similar_word=defang_text(x))) for x in
-                     v['similar_words']]
+                    await self.dao.insert_many('similar_words', [dict(attack_uid=k, similar_word=x)
+                                                                 for x in v['similar_words']])
                 if 'false_negatives' in v:
-                    [await self.dao.insert('false_negatives', dict(uid=k, false_negative=defang_text(x))) for x in
-                     v['false_negatives']]
+                    await self.insert_labelled('false_negatives', k, v['false_negatives'])
                 if 'false_positives' in v:
-                    [await self.dao.insert('false_positives', dict(uid=k, false_positive=defang_text(x))) for x in
-                     v['false_positives']]
+                    await self.insert_labelled('false_positives', k, v['false_positives'])
                 if 'true_positives' in v:
-                    [await self.dao.insert('true_positives', dict(uid=k, true_positive=defang_text(x))) for x in
-                     v['true_positives']]
+                    await self.insert_labelled('true_positives', k, v['true_positives'])
                 if 'example_uses' in v:
-                    [await self.dao.insert('true_positives', dict(uid=k, true_positive=defang_text(x))) for x in
-                     v['example_uses']]
+                    await self.insert_labelled('true_positives', k, v['example_uses'])
+        self.catalog_changed()
         logging.info('[!] DB Item Count: {}'.format(len(await self.dao.get('attack_uids'))))
 
     async def insert_attack_json_data(self, buildfile):
@@ -138,7 +168,7 @@ class DataService:
                                 if item['type'] == "attack-pattern":
                                     loaded_items[item['id']] = {'id': tid, 'name': item['name'],
                                                                 'examples': [],
-                                                                'similar_words': [],
+                                                                'similar_words': [item['name']],
                                                                 'description': item['description'],
                                                                 'example_uses': []}
                         else:
@@ -162,17 +192,150 @@ class DataService:
         to_add = {x: y for x, y in loaded_items.items() if x not in cur_items}
         logging.debug('[#] {} Techniques found that are not in the existing database'.format(len(to_add)))
         for k, v in to_add.items():
-            await self.dao.insert('attack_uids', dict(uid=k, description=defang_text(v['description']), tid=v['id'],
+            await self.dao.insert('attack_uids', dict(uid=k, description=v['description'], tid=v['id'],
                                                       name=v['name']))
             if 'example_uses' in v:
-                [await self.dao.insert('true_positives', dict(uid=k, true_positive=defang_text(x))) for x in
-                 v['example_uses']]
+                await self.insert_labelled('true_positives', k, v['example_uses'])
+            await self.dao.insert_many('similar_words', [dict(attack_uid=k, similar_word=x)
+                                                         for x in v['similar_words']])
+        self.catalog_changed()
+
+    def token_columns(self, text):
+        """:return: the tokens and token_version columns stored alongside a labelled text"""
+        return dict(tokens=self.web_svc.tokenize_batch([text])[0], token_version=TOKENIZER_VERSION)
+
+    async def insert_labelled(self, table, uid, texts):
+        """
+        Function to insert labelled texts for a technique together with their tokens
+        :param table: one of the LABELLED_TEXT tables
+        :param uid: attack uid the texts are labelled with
+        :param texts: list of texts
+        :return: nil
+        """
+        column = dict(LABELLED_TEXT)[table]
+        tokens = await asyncio.get_event_loop().run_in_executor(None, self.web_svc.tokenize_batch, texts)
+        await self.dao.insert_many(table, [{'uid': uid, column: text, 'tokens': token,
+                                            'token_version': TOKENIZER_VERSION} for text, token in zip(texts, tokens)])
+
+    async def backfill_tokens(self, batch_size=1000):
+        """
+        Function to tokenize the labelled texts stored without tokens or by an older tokenizer version
+        :return: number of rows updated
+        """
+        updated = 0
+        loop = asyncio.get_event_loop()
+        for table, column in LABELLED_TEXT:
+            rows = await self.dao.raw_select('SELECT rowid, {} FROM {} WHERE token_version IS NULL OR '
+                                             'token_version != ?'.format(column, table), (TOKENIZER_VERSION,))
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                tokens = await loop.run_in_executor(None, self.web_svc.tokenize_batch,
+                                                    [row[column] or '' for row in batch])
+                # one short transaction per batch, so reviewers' writes are not held up behind the whole backfill
+                async with self.dao.transaction() as tx:
+                    await tx.execute_many('UPDATE {} SET tokens = ?, token_version = ? WHERE rowid = ?'.format(table),
+                                          [(token, TOKENIZER_VERSION, row['rowid'])
+                                           for token, row in zip(tokens, batch)])
+                updated += len(batch)
+        if updated:
+            logging.info('[#] Tokenized {} stored training texts'.format(updated))
+        return updated
+
+    async def backfill_similar_words(self):
+        """
+        Function to give every technique and software with no similar_words its own name as a keyword, as databases
+        built by the earlier JSON loader have none and keyword matching finds nothing in them
+        :return: number of keywords added
+        """
+        # rows loaded by insert_attack_stix_data before attack_uid was filled in carry the technique in uid
+        missing = await self.dao.raw_select('SELECT uid, name FROM attack_uids a WHERE a.name IS NOT NULL AND '
+                                            'a.name != \'\' AND NOT EXISTS (SELECT 1 FROM similar_words s '
+                                            'WHERE COALESCE(s.attack_uid, s.uid) = a.uid)')
+        if missing:
+            await self.dao.insert_many('similar_words', [dict(attack_uid=row['uid'], similar_word=row['name'])
+                                                         for row in missing])
+            self.catalog_changed()
+            logging.info('[#] Added names as keywords for {} techniques and software'.format(len(missing)))
+        return len(missing)
+
+    async def get_stored_tokens(self):
+        """:return: dictionary of labelled text to the tokens stored for it by the current tokenizer"""
+        stored = {}
+        for table, column in LABELLED_TEXT:
+            for row in await self.dao.raw_select('SELECT {} AS text, tokens FROM {} WHERE token_version = ?'
+                                                 .format(column, table), (TOKENIZER_VERSION,)):
+                stored[row['text']] = row['tokens']
+        return stored
+
+    async def report_board(self, page_size=None, pages=None):
+        """
+        Function to group every report by status for the index page, from one briefly cached query
+        :param page_size: Maximum number of reports shown per status column, or None to show them all
+        :param pages: Dictionary of status to the zero-based page shown in that column
+        :return: dictionary of status to its reports, plus a '<status>_count' total and, when paged, the
+                 '<status>_page' shown for each status
+        """
+        now = time.monotonic()
+        if self.board_cache is None or now - self.board_cache[0] > self.board_cache_ttl:
+            board = {status: [] for status in REPORT_STATUSES}
+            for report in await self.dao.raw_select('SELECT uid, title, url, current_status FROM reports ORDER BY uid'):
+                report['link'] = '/edit/{}'.format(report['title'])
+                board.setdefault(report['current_status'], []).append(report)
+            self.board_cache = (now, board)
+        index = {}
+        for status, reports in self.board_cache[1].items():
+            index['{}_count'.format(status)] = len(reports)
+            if page_size:
+                # a page past the end shows the last one
+                page = min(max(0, (pages or {}).get(status, 0)), max(0, (len(reports) - 1) // page_size))
+                index['{}_page'.format(status)] = page
+                reports = reports[page * page_size:(page + 1) * page_size]
+            index[status] = reports
+        return index
+
+    def invalidate_report_board(self):
+        self.board_cache = None
+
+    async def delete_report(self, report_id):
+        """
+        Function to delete a report and everything recorded against it in one transaction
+        :param report_id: uid of the report
+        :return: nil
+        """
+        async with self.dao.transaction() as tx:
+            for table in ('true_positives', 'false_positives', 'false_negatives'):
+                await tx.execute('DELETE FROM {} WHERE sentence_id IN '
+                                 '(SELECT uid FROM report_sentences WHERE report_uid = ?)'.format(table), (report_id,))
+            for table in ('report_sentence_hits', 'original_html', 'report_sentences'):
+                await tx.delete(table, dict(report_uid=report_id))
+            await tx.delete('reports', dict(uid=report_id))
+        self.invalidate_report_board()
+
+    async def compact_database(self):
+        """
+        Function to return free pages to the filesystem and refresh the query planner statistics
+        :return: dictionary with the database size in bytes before and after
+        """
+        result = await self.dao.compact()
+        if result['vacuumed']:
+            # a full VACUUM can renumber the implicit rowids these full-text indexes point at
+            for table in ('true_positives', 'false_positives'):
+                await self.dao.raw_update("INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(table))
+        logging.info('[#] Compacted database from {bytes_before} to {bytes_after} bytes'.format(**result))
+        return result
 
-    async def status_grouper(self, status):
-        reports = await self.dao.get('reports', dict(current_status=status))
-        for report in reports:
-            report.update(dict(link="/edit/{}".format(report['title'])))
-        return reports
+    async def schedule_compaction(self, interval_hours):
+        """
+        Function to compact the database every interval_hours while the server runs
+        :param interval_hours: Hours between compactions
+        :return: nil
+        """
+        while True:
+            await asyncio.sleep(interval_hours * 3600)
+            try:
+                await self.compact_database()
+            except Exception as exc:
+                logging.error('[!] Database compaction failed: {}'.format(exc))
 
     async def last_technique_check(self, criteria):
         await self.dao.delete('report_sentence_hits', dict(uid=criteria['sentence_id'], attack_uid=criteria['attack_uid']))
@@ -184,45 +347,145 @@ class DataService:
             return dict(status='false', id=criteria['sentence_id'])
 
     async def build_sentences(self, report_id):
-        sentences = await self.dao.get('report_sentences', dict(report_uid=report_id))
+        """
+        Function to load a report's sentences with their hits and review state in two joined queries
+        :param report_id: uid of the report
+        :return: list of sentences, each with its hits (including the technique's tid/name and any
+                 confirming text) and whether it has a confirmed technique
+        """
+        sentences = await self.dao.raw_select(
+            'SELECT report_sentences.*, CASE WHEN EXISTS (SELECT 1 FROM true_positives '
+            'WHERE true_positives.sentence_id = report_sentences.uid) THEN \'true\' ELSE \'false\' END AS confirmed '
+            'FROM report_sentences WHERE report_sentences.report_uid = ? ORDER BY report_sentences.uid', (report_id,))
+        hits = await self.dao.raw_select(
+            'SELECT report_sentence_hits.*, attack_uids.tid AS technique_tid, attack_uids.name AS technique_name, '
+            'COALESCE((SELECT true_positive FROM true_positives WHERE true_positives.sentence_id = report_sentence_hits.uid '
+            'AND true_positives.uid = report_sentence_hits.attack_uid), '
+            '(SELECT false_negative FROM false_negatives WHERE false_negatives.sentence_id = report_sentence_hits.uid '
+            'AND false_negatives.uid = report_sentence_hits.attack_uid)) AS confirmed_text '
+            'FROM report_sentence_hits LEFT JOIN attack_uids ON attack_uids.uid = report_sentence_hits.attack_uid '
+            'WHERE report_sentence_hits.report_uid = ? ORDER BY report_sentence_hits.rowid', (report_id,))
+        sentence_hits = {}
+        for hit in hits:
+            sentence_hits.setdefault(hit['uid'], []).append(hit)
         for sentence in sentences:
-            sentence['hits'] = await self.dao.get('report_sentence_hits', dict(uid=sentence['uid']))
-            if await self.dao.get('true_positives', dict(sentence_id=sentence['uid'])):
-                sentence['confirmed'] = 'true'
-            else:
-                sentence['confirmed'] = 'false'
+            sentence['hits'] = sentence_hits.get(sentence['uid'], [])
         return sentences
 
     async def get_techniques(self):
-        techniques = await self.dao.get('attack_uids')
+        index = await self.get_technique_index()
+        return list(index['all'])
+
+    async def get_technique_index(self):
+        """
+        Function to get the in-memory ATT&CK catalog, loading it from attack_uids on first use
+        :return: dictionary with every row under 'all' and the rows keyed by 'uid', 'tid' and 'name'
+        """
+        if self.technique_index is None:
+            rows = await self.dao.get('attack_uids')
+            index = dict(all=rows, uid={}, tid={}, name={})
+            for row in rows:
+                # the first row wins on duplicates, as the per-hit queries this replaces did
+                for key in ('uid', 'tid', 'name'):
+                    index[key].setdefault(row[key], row)
+            self.technique_index = index
+        return self.technique_index
+
+    def invalidate_technique_index(self):
+        self.technique_index = None
+
+    def on_catalog_change(self, callback):
+        """Function to have callback() run whenever the loaders change the techniques and what is matched to them"""
+        self.catalog_listeners.append(callback)
+
+    def catalog_changed(self):
+        self.invalidate_technique_index()
+        for callback in self.catalog_listeners:
+            callback()
+
+    async def resolve_technique(self, technique, keys=('name', 'tid', 'uid')):
+        """
+        Function to find a technique in the catalog by the first of the given keys that matches
+        :param technique: Technique name, tid or uid
+        :param keys: Catalog keys to try, in order
+        :return: copy of the attack_uids row, or None if nothing matches
+        """
+        index = await self.get_technique_index()
+        for key in keys:
+            if technique in index[key]:
+                return dict(index[key][technique])
+        return None
+
+    async def get_training_techniques(self):
+        """
+        Function to build the training data for every technique (software is skipped) in one pass per table
+        :return: dictionary of technique uid to its id, name, example uses and false positives
+        """
+        techniques = {}
+        for row in await self.dao.raw_select('SELECT uid, tid, name FROM attack_uids ORDER BY rowid'):
+            if 'tool' in row['tid'] or 'malware' in row['tid']:
+                continue
+            techniques[row['uid']] = {'id': row['tid'], 'name': row['name'], 'similar_words': [],
+                                      'example_uses': [], 'false_positives': []}
+        # false negatives follow the true positives in example_uses, as both are confirmed examples
+        for table, column, key in (('true_positives', 'true_positive', 'example_uses'),
+                                   ('false_negatives', 'false_negative', 'example_uses'),
+                                   ('false_positives', 'false_positive', 'false_positives')):
+            for row in await self.dao.raw_select('SELECT uid, {} FROM {} ORDER BY rowid'.format(column, table)):
+                if row['uid'] in techniques:
+                    techniques[row['uid']][key].append(row[column])
         return techniques
 
-    async def get_confirmed_techniques(self, report_id):
-        # The SQL select join query to retrieve the confirmed techniques for the report from the database
-        select_join_query = (
-            f"SELECT report_sentences.uid, report_sentence_hits.attack_uid, report_sentence_hits.report_uid, report_sentence_hits.attack_tid, true_positives.true_positive " 
-            f"FROM ((report_sentences INNER JOIN report_sentence_hits ON report_sentences.uid = report_sentence_hits.uid) " 
-            f"INNER JOIN true_positives ON report_sentence_hits.uid = true_positives.sentence_id AND report_sentence_hits.attack_uid = true_positives.uid) " 
-            f"WHERE report_sentence_hits.report_uid = {report_id} "
-            f"UNION "
-            f"SELECT report_sentences.uid, report_sentence_hits.attack_uid, report_sentence_hits.report_uid, report_sentence_hits.attack_tid, false_negatives.false_negative " 
-            f"FROM ((report_sentences INNER JOIN report_sentence_hits ON report_sentences.uid = report_sentence_hits.uid) " 
-            f"INNER JOIN false_negatives ON report_sentence_hits.uid = false_negatives.sentence_id AND report_sentence_hits.attack_uid = false_negatives.uid) " 
-            f"WHERE report_sentence_hits.report_uid = {report_id}")
-        # Run the SQL select join query
-        hits = await self.dao.raw_select(select_join_query)
-        techniques = []
-        for hit in hits:
-            # For each confirmed technique returned,
-            # create a technique object and add it to the list of techniques.
-            technique = {}
-            technique['score'] = 1
-            technique['techniqueID'] = hit['attack_tid'] 
-            technique['comment'] = hit['true_positive']
-            techniques.append(technique)
-        # Return the list of confirmed techniques
+    async def get_confirmed_techniques(self, report_id, sentences=None):
+        """
+        Function to list the techniques analysts confirmed (true positives or false negatives) in a report
+        :param report_id: uid of the report
+        :param sentences: The report's sentences from build_sentences, loaded if not given
+        :return: list of navigator layer technique entries
+        """
+        if sentences is None:
+            sentences = await self.build_sentences(report_id)
+        techniques, seen = [], set()
+        for sentence in sentences:
+            for hit in sentence['hits']:
+                key = (hit['uid'], hit['attack_uid'])
+                if hit['confirmed_text'] is None or key in seen:
+                    continue
+                seen.add(key)
+                techniques.append(dict(score=1, techniqueID=hit['attack_tid'], comment=hit['confirmed_text']))
         return techniques
 
+    async def search_text(self, query, scope='all', limit=50):
+        """
+        Function to find a phrase across analysed report sentences and the labelled examples
+        :param query: Phrase to search for
+        :param scope: 'sentences', 'true_positives', 'false_positives' or 'all'
+        :param limit: Maximum number of matches returned from each source
+        :return: list of matches, best first, with their source, report/sentence ids and a highlighted snippet
+        """
+        # quote the input as one FTS5 phrase so analyst text is never parsed as query syntax
+        phrase = '"{}"'.format(query.replace('"', '""'))
+        matches = []
+        if scope in ('all', 'sentences'):
+            matches.extend(await self.dao.raw_select(
+                'SELECT \'sentences\' AS source, report_sentences.uid AS sentence_id, report_sentences.report_uid, '
+                'reports.title, NULL AS attack_uid, snippet(report_sentences_fts, 0, \'<b>\', \'</b>\', \'...\', 16) '
+                'AS snippet, bm25(report_sentences_fts) AS rank FROM report_sentences_fts '
+                'JOIN report_sentences ON report_sentences.uid = report_sentences_fts.rowid '
+                'LEFT JOIN reports ON reports.uid = report_sentences.report_uid '
+                'WHERE report_sentences_fts MATCH ? ORDER BY rank LIMIT ?', (phrase, limit)))
+        for table in ('true_positives', 'false_positives'):
+            if scope not in ('all', table):
+                continue
+            matches.extend(await self.dao.raw_select(
+                'SELECT \'{table}\' AS source, {table}.sentence_id, report_sentences.report_uid, reports.title, '
+                '{table}.uid AS attack_uid, snippet({table}_fts, 0, \'<b>\', \'</b>\', \'...\', 16) AS snippet, '
+                'bm25({table}_fts) AS rank FROM {table}_fts JOIN {table} ON {table}.rowid = {table}_fts.rowid '
+                'LEFT JOIN report_sentences ON report_sentences.uid = {table}.sentence_id '
+                'LEFT JOIN reports ON reports.uid = report_sentences.report_uid '
+                'WHERE {table}_fts MATCH ? ORDER BY rank LIMIT ?'.format(table=table), (phrase, limit)))
+        return sorted(matches, key=lambda match: match['rank'])
+
     async def ml_reg_split(self, techniques):
         list_of_legacy, list_of_techs = [], []
         for k, v in techniques.items():
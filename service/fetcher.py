@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+import aiohttp
+
+# statuses that are worth asking again for, anything else outside 2xx fails straight away
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+
+class FetchError(Exception):
+    pass
+
+
+class _Retryable(Exception):
+    pass
+
+
+class Fetcher:
+    """
+    Downloads report pages over one shared aiohttp session, so connections are reused between reports and the
+    number open to any one site is capped. Each page is fetched once and the same html is handed to every stage
+    that needs it.
+    """
+
+    def __init__(self, limit=20, limit_per_host=4, timeout=30, connect_timeout=10, max_bytes=10 * 1024 * 1024,
+                 retries=3, backoff=0.5):
+        """
+        :param limit: Most connections open at once
+        :param limit_per_host: Most connections open to one host at once
+        :param timeout: Seconds a whole download may take
+        :param connect_timeout: Seconds to wait for a connection
+        :param max_bytes: Largest page body accepted
+        :param retries: Attempts after the first for connection errors, timeouts and retryable statuses
+        :param backoff: Seconds to wait before the first retry, doubled for each one after it
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+
+    def _get_session(self):
+        # created on first use, so it is bound to the loop the server runs on
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            timeout = aiohttp.ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def fetch(self, url):
+        """
+        Download a page, retrying with exponential backoff
+        :return: the page's html
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._fetch_once(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, _Retryable) as exc:
+                # a timeout has no message of its own
+                reason = str(exc) or type(exc).__name__
+                if attempt == self.retries:
+                    raise FetchError('Could not download {}: {}'.format(url, reason)) from exc
+                logging.debug('[!] Download of {} failed ({}), retrying in {}s'.format(url, reason, delay))
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _fetch_once(self, url):
+        async with self._get_session().get(url) as response:
+            if response.status in RETRY_STATUSES:
+                raise _Retryable('HTTP {}'.format(response.status))
+            if response.status >= 400:
+                raise FetchError('Could not download {}: HTTP {}'.format(url, response.status))
+            if response.content_length and response.content_length > self.max_bytes:
+                raise FetchError('{} is larger than {} bytes'.format(url, self.max_bytes))
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body.extend(chunk)
+                if len(body) > self.max_bytes:
+                    raise FetchError('{} is larger than {} bytes'.format(url, self.max_bytes))
+            try:
+                return bytes(body).decode(response.charset or 'utf-8', errors='replace')
+            except LookupError:
+                # the server named a charset python does not know
+                return bytes(body).decode('utf-8', errors='replace')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
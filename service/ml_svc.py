@@ -1,122 +1,434 @@
-import pandas as pd
+import numpy as np
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression
-import os, pickle, random
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.preprocessing import MultiLabelBinarizer
+from scipy.special import expit
+import sklearn
+from concurrent.futures import ProcessPoolExecutor
+import os, json, functools, hashlib, random, time, zlib
+import multiprocessing
+import threading
 import nltk
 import logging
 import asyncio
 
+from service.model_store import ModelStore
+from service.web_svc import TOKENIZER_VERSION, tokenize_text
+
+
+ENGINES = ('per_technique', 'multilabel')
+ATTACK_DICT = 'models/attack_dict.json'
+
+# tokenized training corpus, set once per worker process by the pool initializer
+_training_corpus = None
+
+
+def _init_training(corpus):
+    global _training_corpus
+    _training_corpus = corpus
+
+
+def _load_json(path):
+    with open(path, 'r', encoding='utf_8') as f:
+        return json.load(f)
+
+
+def training_fingerprint(engine, list_of_techs, techniques, true_negatives):
+    """Digest of everything a build is trained from, recorded in the model store manifest"""
+    digest = hashlib.sha256(json.dumps([engine, TOKENIZER_VERSION, sorted(list_of_techs)]).encode('utf-8'))
+    for k in sorted(techniques):
+        v = techniques[k]
+        digest.update(json.dumps([k, v['name'], v['example_uses'], v.get('false_positives', [])]).encode('utf-8'))
+    digest.update(json.dumps(true_negatives).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def technique_fingerprints(list_of_techs, techniques, true_negatives):
+    """
+    Digest of each technique's own training inputs: its examples (the catalog's plus confirmed true positives and
+    false negatives), its false positives, its seed, the true negatives and the tokenizer version. Other
+    techniques' examples are left out on purpose, as they only feed the random half of the negative class and
+    would tie every model to every label; a full rebuild resamples them.
+    :return: dictionary of technique name to hex digest
+    """
+    inputs = {tech: ([], []) for tech in list_of_techs}
+    for k in sorted(techniques):
+        v = techniques[k]
+        if v['name'] in inputs:
+            inputs[v['name']][0].extend(v['example_uses'])
+            inputs[v['name']][1].extend(v.get('false_positives', []))
+    negatives = hashlib.sha256(json.dumps(true_negatives).encode('utf-8')).hexdigest()
+    return {tech: hashlib.sha256(json.dumps([examples, false_positives, technique_seed(tech), negatives,
+                                             TOKENIZER_VERSION]).encode('utf-8')).hexdigest()
+            for tech, (examples, false_positives) in inputs.items()}
+
+
+def technique_seed(tech_name):
+    """Stable seed per technique, so a model comes out the same whichever process or order it is built in"""
+    return zlib.crc32(tech_name.encode('utf-8'))
+
+
+def train_technique(tech_name, corpus=None):
+    """
+    Function to build one technique's Logistic Regression Classification model from the tokenized corpus
+    :param tech_name: Name of the technique to build the positive class from
+    :param corpus: Tokenized corpus from MLService.build_training_corpus, defaults to the worker's copy
+    :return: tuple of the vectorizer, the classifier and its score on the held out split
+    """
+    corpus = corpus or _training_corpus
+    seed = technique_seed(tech_name)
+    rng = random.Random(seed)
+    positives = corpus['examples'].get(tech_name, [])
+    false_list = [example for name, examples in corpus['examples'].items() if name != tech_name
+                  for example in examples]
+
+    # the incorrectly labeled texts from reviewed reports go in the Negative Class too
+    sampling = list(corpus['false_positives'].get(tech_name, []))
+    # at least 90% of total labels for both classes, use this for determining how many labels to use for classifier's negative class
+    kval = int((len(positives) * 10))
+    # make first half random set of true negatives that have no relation/label to ANY technique
+    sampling.extend(rng.choices(corpus['true_negatives'], k=kval))
+    # do second random half set, these are true/positive labels for OTHER techniques
+    sampling.extend(rng.choices(false_list, k=kval))
+
+    # build model based on that technique, keeping the count matrix sparse throughout
+    cv = CountVectorizer(max_features=2000)
+    X = cv.fit_transform(positives + sampling)
+    y = np.array([True] * len(positives) + [False] * len(sampling))
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=seed)
+    logreg = LogisticRegression(max_iter=2500, solver='lbfgs', random_state=seed)
+    logreg.fit(X_train, y_train)
+    return cv, logreg, logreg.score(X_test, y_test)
+
+
+def score_document(engine, list_of_techs, models, cleaned_sentences):
+    """
+    Function to score a tokenized document against every technique at once
+    :return: technique names and a sentences x techniques array of the probability each technique applies
+    """
+    if engine == 'multilabel':
+        techs = list(models['labels'])
+        if not cleaned_sentences:
+            return techs, np.empty((0, len(techs)))
+        # the logistic of the decision value is what predict_proba returns for the positive class
+        return techs, expit(np.asarray(models['cv'].transform(cleaned_sentences) @ models['coef'].T
+                                       + models['intercept']))
+    techs = [tech for tech in list_of_techs if tech in models]
+    probabilities = np.empty((len(cleaned_sentences), len(techs)))
+    if cleaned_sentences:
+        for col, tech in enumerate(techs):
+            cv, logreg = models[tech]
+            positive = list(logreg.classes_).index(True)
+            probabilities[:, col] = logreg.predict_proba(cv.transform(cleaned_sentences))[:, positive]
+    return techs, probabilities
+
+
+# models held by an analysis worker, keyed by model store version. The lock matters for a thread pool, where every
+# worker shares the one dictionary
+_analysis_models = {}
+_analysis_lock = threading.Lock()
+
+
+def preload_models(store_root, engine):
+    """Analysis worker initializer, loading the live models before the first document arrives"""
+    version = ModelStore(store_root).current_version()
+    if version:
+        _worker_models(store_root, engine, version)
+
+
+def _worker_models(store_root, engine, version):
+    with _analysis_lock:
+        models = _analysis_models.get(version)
+        if models is None:
+            stored = ModelStore(store_root).load(version)
+            # load every artifact up front, the worker keeps them for every document it scores
+            models = stored['multilabel'] if engine == 'multilabel' else {name: stored[name] for name in stored}
+            # a new version replaces the old, documents still being scored keep their own reference to it
+            _analysis_models.clear()
+            _analysis_models[version] = models
+    return models
+
+
+def analyze_sentences(store_root, engine, version, list_of_techs, texts):
+    """Analysis worker function to tokenize and score a document against one model version"""
+    models = _worker_models(store_root, engine, version)
+    return score_document(engine, list_of_techs, models, [tokenize_text(text) for text in texts])
+
 
 class MLService:
 
-    # Service to perform the machine learning against the pickle file
-    def __init__(self, web_svc, dao):
+    # Service to perform the machine learning against the model store
+    def __init__(self, web_svc, dao, data_svc, model_store, engine='per_technique', workers=None, threshold=0.5,
+                 pool=None):
+        """
+        :param engine: 'per_technique' trains a vectorizer and classifier per technique, 'multilabel' trains one
+                       shared vocabulary with a one-vs-rest coefficient matrix over all techniques
+        :param model_store: ModelStore the trained models are versioned in
+        :param workers: Number of processes to train models with, defaults to one per core
+        :param threshold: Probability a technique has to exceed to be reported for a sentence, 0.5 matches predict()
+        :param pool: WorkerPool to score documents in, they are scored in the default executor without one
+        """
+        if engine not in ENGINES:
+            raise ValueError('Unknown ML engine: {}'.format(engine))
+        if not 0 < threshold < 1:
+            raise ValueError('ML threshold must be between 0 and 1: {}'.format(threshold))
         self.web_svc = web_svc
         self.dao = dao
+        self.data_svc = data_svc
+        self.model_store = model_store
+        self.engine = engine
+        self.threshold = threshold
+        self.pool = pool
+        self.workers = workers or os.cpu_count() or 1
+        self.build_status = dict(state='idle', engine=engine, total=0, completed=0, failed=[], started=None,
+                                 finished=None)
+        # models and technique lists shared by every analysis, replaced as a whole when a rebuild finishes
+        self.resident = None
+        self._resident_lock = None
 
     async def build_models(self, tech_name, techniques, true_negatives):
         """Function to build Logistic Regression Classification models based off of the examples provided"""
-        lst1, lst2, false_list, sampling = [], [], [], []
-        getuid = ""
-        len_truelabels = 0
-
-        for k, v in techniques.items():
-            if v['name'] == tech_name:
-                for i in v['example_uses']:
-                    lst1.append(self.web_svc.tokenize(self, i))
-                    lst2.append(True)
-                    len_truelabels += 1
-                    getuid = k
-                # collect the false_positive samples here too, which are the incorrectly labeled texts from reviewed reports, we will include these in the Negative Class.
-                for fp in v['false_positives']:
-                    sampling.append(fp)
-            else:
-                for i in v['example_uses']:
-                    false_list.append(self.web_svc.tokenize(self, i))
-
-        # at least 90% of total labels for both classes, use this for determining how many labels to use for classifier's negative class
-        kval = int((len_truelabels * 10))
-
-        # make first half random set of true negatives that have no relation/label to ANY technique
-        sampling.extend(random.choices(true_negatives, k=kval))
-
-        # do second random half set, these are true/positive labels for OTHER techniques, use list obtained from above
-        sampling.extend(random.choices(false_list, k=kval))
-
-        # Finally, create the Negative Class for this technique's classification model, include False as the labels for this training data
-        for false_label in sampling:
-            lst1.append(self.web_svc.tokenize(self, false_label))
-            lst2.append(False)
-
-        # convert into a dataframe
-        df = pd.DataFrame({'text': lst1, 'category': lst2})
-
-        # build model based on that technique
-        cv = CountVectorizer(max_features=2000)
-        X = cv.fit_transform(df['text']).toarray()
-        y = df['category']
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
-        logreg = LogisticRegression(max_iter=2500, solver='lbfgs')
-        logreg.fit(X_train, y_train)
-
-        print("{} - {}".format(tech_name, logreg.score(X_test, y_test)))
+        corpus = await self.build_training_corpus(techniques, true_negatives)
+        cv, logreg, score = train_technique(tech_name, corpus)
+        logging.info('[#] {} - {}'.format(tech_name, score))
         return (cv, logreg)
 
-    async def analyze_document(self, cv, logreg, sentences):
-        cleaned_sentences = [await self.web_svc.tokenize(i['text']) for i in sentences]
-
-        df2 = pd.DataFrame({'text': cleaned_sentences})
-        Xnew = cv.transform(df2['text']).toarray()
-        await asyncio.sleep(0.01)
-        y_pred = logreg.predict(Xnew)
-        df2['category'] = y_pred.tolist()
-        return df2
-
-    async def build_pickle_file(self, list_of_techs, techniques, force=False):
-        if not os.path.isfile('models/model_dict.p') or force:
-            model_dict = {}
-            total = len(list_of_techs)
-            count = 1
-            print(
-                "Building Classification Models.. This could take anywhere from ~30-60+ minutes. Please do not close terminal.")
-            for i in list_of_techs:
-                print('[#] Building.... {}/{}'.format(count, total))
-                count += 1
-                model_dict[i] = self.build_models(self, i, techniques)
-            print('[#] Saving models to pickled file: model_dict.p')
-            pickle.dump(model_dict, open('models/model_dict.p', 'wb'))
+    async def build_training_corpus(self, techniques, true_negatives):
+        """
+        Function to tokenize every training text once, so the per technique builds only sample from the result
+        :return: dictionary of tokenized examples and false positives by technique name, and the true negatives
+        """
+        texts = {}
+        for v in techniques.values():
+            texts.update(dict.fromkeys(v['example_uses']))
+            texts.update(dict.fromkeys(v.get('false_positives', [])))
+        texts.update(dict.fromkeys(true_negatives))
+        # labelled rows keep their tokens in the database, so only texts without them are tokenized here
+        tokenized = await self.data_svc.get_stored_tokens()
+        missing = [text for text in texts if text not in tokenized]
+        tokenized.update(zip(missing, await self.tokenize_all(missing)))
+
+        examples, false_positives = {}, {}
+        for v in techniques.values():
+            for i in v['example_uses']:
+                examples.setdefault(v['name'], []).append(tokenized[i])
+            for fp in v.get('false_positives', []):
+                false_positives.setdefault(v['name'], []).append(tokenized[fp])
+        return dict(examples=examples, false_positives=false_positives,
+                    true_negatives=[tokenized[tn] for tn in true_negatives])
+
+    async def tokenize_all(self, texts):
+        """Function to tokenize a list of texts in one batch off the event loop"""
+        return await asyncio.get_event_loop().run_in_executor(None, self.web_svc.tokenize_batch, texts)
+
+    async def train_models(self, list_of_techs, techniques, true_negatives):
+        """
+        Function to train the per technique models across a process pool, keeping the event loop free while it runs
+        :return: dictionary of technique name to its (vectorizer, classifier) pair, and one of their scores
+        """
+        corpus = await self.build_training_corpus(techniques, true_negatives)
+        self.build_status.update(total=len(list_of_techs), completed=0, failed=[])
+        model_dict, scores = {}, {}
+        # the corpus is handed to each worker once through the initializer rather than with every technique
+        # spawn rather than fork, as the server's database and analysis threads could hold a lock the child inherits
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_training, initargs=(corpus,))
+        futures = {}
+        try:
+            futures = {pool.submit(train_technique, tech): tech for tech in list_of_techs}
+
+            async def train(future):
+                try:
+                    return futures[future], await asyncio.wrap_future(future), None
+                except Exception as exc:
+                    return futures[future], None, exc
+
+            for next_done in asyncio.as_completed([train(future) for future in futures]):
+                tech, result, exc = await next_done
+                if exc is not None:
+                    logging.error('[!] Could not build model for {}: {}'.format(tech, exc))
+                    self.build_status['failed'].append(tech)
+                    continue
+                cv, logreg, score = result
+                model_dict[tech], scores[tech] = (cv, logreg), score
+                self.build_status['completed'] += 1
+                logging.info('[#] Built {}/{}: {} - {}'.format(self.build_status['completed'], len(list_of_techs),
+                                                               tech, score))
+        finally:
+            # a with block would wait for every queued technique on the event loop thread if the build is cancelled,
+            # so drop what has not started and let the workers exit in the background
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+        # keep the technique order stable no matter which worker finished first
+        return {tech: model_dict[tech] for tech in list_of_techs if tech in model_dict}, scores
+
+    async def build_multilabel_model(self, list_of_techs, techniques, true_negatives):
+        """
+        Function to build one Logistic Regression model per technique over a single shared vocabulary, so a document
+        is vectorized once and every technique is scored by one sparse matrix product
+        :return: dictionary of the vectorizer, the technique names and their stacked coefficients and intercepts
+        """
+        corpus = await self.build_training_corpus(techniques, true_negatives)
+        labels = {}
+        for tech in list_of_techs:
+            for example in corpus['examples'].get(tech, []):
+                labels.setdefault(example, set()).add(tech)
+        # true negatives and reviewed false positives only contribute to the negative class
+        for fps in corpus['false_positives'].values():
+            for fp in fps:
+                labels.setdefault(fp, set())
+        for tn in corpus['true_negatives']:
+            labels.setdefault(tn, set())
+
+        texts = list(labels)
+        classes = [tech for tech in list_of_techs if any(tech in labels[text] for text in texts)]
+        cv = CountVectorizer(max_features=20000)
+        X = cv.fit_transform(texts)
+        y = MultiLabelBinarizer(classes=classes).fit_transform([labels[text] for text in texts])
+        ovr = OneVsRestClassifier(LogisticRegression(max_iter=2500, solver='lbfgs'), n_jobs=self.workers)
+        self.build_status.update(total=len(classes), completed=0, failed=[])
+        # fit off the event loop, the estimators themselves are spread over the worker processes
+        await asyncio.get_event_loop().run_in_executor(None, ovr.fit, X, y)
+        self.build_status['completed'] = len(classes)
+        return dict(cv=cv, labels=classes, coef=np.vstack([est.coef_ for est in ovr.estimators_]),
+                    intercept=np.hstack([est.intercept_ for est in ovr.estimators_]))
+
+    async def load_models(self, list_of_techs, techniques, true_negatives, force=False, full=False):
+        """
+        Function to load the live models from the model store, building a new version first when needed
+        :param force: retrain the techniques whose training inputs changed since the live version was built
+        :param full: retrain every technique, as is always done when the store is empty or the live version was
+                     built by another engine or sklearn version
+        :return: mapping of technique name to model for 'per_technique', the model itself for 'multilabel'
+        """
+        manifest = self.model_store.manifest()
+        if not manifest or manifest['engine'] != self.engine or manifest['sklearn_version'] != sklearn.__version__:
+            full = True
+        if full or force:
+            self.build_status.update(state='building', started=time.time(), finished=None)
+            try:
+                if self.engine == 'multilabel':
+                    version = await self._build_multilabel(list_of_techs, techniques, true_negatives, manifest, full)
+                else:
+                    version = await self._build_per_technique(list_of_techs, techniques, true_negatives, manifest,
+                                                              full)
+            except Exception:
+                self.build_status.update(state='failed', finished=time.time())
+                raise
+            self.build_status.update(state='completed', finished=time.time())
+            if version:
+                logging.info('[#] Saved models as version {}'.format(version))
+        models = self.model_store.load()
+        logging.info('[#] Loading models from version {}'.format(models.manifest['version']))
+        return models['multilabel'] if self.engine == 'multilabel' else models
+
+    async def _build_multilabel(self, list_of_techs, techniques, true_negatives, manifest, full):
+        # every technique shares the one model, so any change to the training set retrains all of it
+        fingerprint = training_fingerprint(self.engine, list_of_techs, techniques, true_negatives)
+        if not full and manifest['fingerprint'] == fingerprint:
+            logging.info('[#] Training set is unchanged, keeping model version {}'.format(manifest['version']))
+            return None
+        logging.info('[#] Building the multilabel model, please do not close the terminal')
+        model = await self.build_multilabel_model(list_of_techs, techniques, true_negatives)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.model_store.save, dict(multilabel=model), self.engine, fingerprint,
+            dict(classes=len(model['labels'])))
+
+    async def _build_per_technique(self, list_of_techs, techniques, true_negatives, manifest, full):
+        fingerprints = technique_fingerprints(list_of_techs, techniques, true_negatives)
+        previous = {} if full else manifest.get('fingerprints', {})
+        stale = [tech for tech in list_of_techs if previous.get(tech) != fingerprints[tech]]
+        if manifest and not stale and set(manifest['artifacts']) == set(list_of_techs):
+            self.build_status.update(total=0, completed=0, failed=[])
+            logging.info('[#] No technique has new training data, keeping model version {}'
+                         .format(manifest['version']))
+            return None
+        logging.info('[#] Building {} of {} classification models with {} worker(s), please do not close the '
+                     'terminal'.format(len(stale), len(list_of_techs), self.workers))
+        models, scores = await self.train_models(stale, techniques, true_negatives)
+        # unchanged techniques, and any that failed to retrain, keep the live version's model
+        reuse = [tech for tech in list_of_techs if tech not in models and tech in previous]
+        for tech in reuse:
+            scores[tech] = manifest['metrics']['scores'].get(tech)
+            fingerprints[tech] = previous[tech]
+        for tech in set(fingerprints) - set(models) - set(reuse):
+            del fingerprints[tech]
+        metrics = dict(scores=scores, failed=self.build_status['failed'], retrained=sorted(models))
+        fingerprint = training_fingerprint(self.engine, list_of_techs, techniques, true_negatives)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(self.model_store.save, models, self.engine, fingerprint, metrics,
+                                    fingerprints=fingerprints, reuse=reuse))
+
+    async def load_resident(self, techniques=None, force=False, full=False):
+        """
+        Function to load the models and the technique catalog they were trained on, and make them the live set
+        :param techniques: training techniques, read from the attack_dict.json catalog when not given
+        :param force: retrain the techniques whose training data changed instead of only loading the live version
+        :param full: retrain every technique
+        :return: the new resident dictionary
+        """
+        if techniques is None:
+            techniques = await asyncio.get_event_loop().run_in_executor(None, _load_json, ATTACK_DICT)
+        list_of_legacy, list_of_techs = await self.data_svc.ml_reg_split(techniques)
+        true_negatives = await self.get_true_negs()
+        models = await self.load_models(list_of_techs, techniques, true_negatives, force=force, full=full)
+        manifest = self.model_store.manifest()
+        # one assignment, so an analysis already running keeps the set it started with
+        self.resident = dict(models=models, list_of_techs=list_of_techs, list_of_legacy=list_of_legacy,
+                             version=manifest['version'], manifest=manifest, loaded=time.time())
+        logging.info('[#] Model version {} is resident'.format(manifest['version']))
+        return self.resident
+
+    async def get_resident(self):
+        """:return: the resident models, loading them the first time they are needed"""
+        if self._resident_lock is None:
+            self._resident_lock = asyncio.Lock()
+        async with self._resident_lock:
+            if self.resident is None:
+                await self.load_resident()
+        return self.resident
+
+    async def analyze_html(self, list_of_techs, model_dict, list_of_sentences, version=None):
+        """
+        Function to score every sentence against every technique and record the techniques found
+        :param version: model store version of model_dict, lets a worker pool score with its preloaded copy
+        :return: the sentences, each with the techniques scoring above the threshold and their probabilities
+        """
+        texts = [i['text'] for i in list_of_sentences]
+        if self.pool and version:
+            techs, probabilities = await self.pool.run(analyze_sentences, self.model_store.root, self.engine,
+                                                       version, list_of_techs, texts)
         else:
-            print('[#] Loading models from pickled file: model_dict.p')
-            model_dict = pickle.load(open('models/model_dict.p', 'rb'))
-        return model_dict
-
-    async def analyze_html(self, list_of_techs, model_dict, list_of_sentences):
-        for i in list_of_techs:
-            cv, logreg = model_dict[i]
-            final_df = await self.analyze_document(cv, logreg, list_of_sentences)
-            count = 0
-            for vals in final_df['category']:
-                await asyncio.sleep(0.001)
-                if vals == True:
-                    list_of_sentences[count]['ml_techniques_found'].append(i)
-                count += 1
+            # tokenize the document once rather than once per technique
+            cleaned_sentences = await self.tokenize_all(texts)
+            techs, probabilities = await asyncio.get_event_loop().run_in_executor(
+                None, score_document, self.engine, list_of_techs, model_dict, cleaned_sentences)
+        for row, col in zip(*np.nonzero(probabilities > self.threshold)):
+            list_of_sentences[row]['ml_techniques_found'].append(techs[col])
+            list_of_sentences[row]['ml_probabilities'][techs[col]] = float(probabilities[row, col])
         return list_of_sentences
 
     async def ml_techniques_found(self, report_id, sentence):
-        sentence_id = await self.dao.insert('report_sentences',
-                                            dict(report_uid=report_id, text=sentence['text'], html=sentence['html'],
-                                                 found_status="true"))
+        """
+        Function to build the report_sentence_hits rows for the ML techniques found in a sentence
+        :param report_id: uid of the report the sentence belongs to
+        :param sentence: Analyzed sentence dictionary
+        :return: list of hit rows, keyed to the sentence once it has been inserted
+        """
+        hits = []
         for technique in sentence['ml_techniques_found']:
-            attack_uid = await self.dao.get('attack_uids', dict(name=technique))
+            attack_uid = await self.data_svc.resolve_technique(technique, keys=('name', 'tid'))
             if not attack_uid:
-                attack_uid = await self.dao.get('attack_uids', dict(tid=technique))
-            attack_technique = attack_uid[0]['uid']
-            attack_technique_name = '{} (m)'.format(attack_uid[0]['name'])
-            attack_tid = attack_uid[0]['tid']
-            await self.dao.insert('report_sentence_hits',
-                                  dict(uid=sentence_id, attack_uid=attack_technique,
-                                       attack_technique_name=attack_technique_name, report_uid=report_id, attack_tid = attack_tid))
+                logging.warning('[!] ML technique {} is not in attack_uids, skipping'.format(technique))
+                continue
+            attack_technique_name = '{} (m)'.format(attack_uid['name'])
+            hits.append(dict(attack_uid=attack_uid['uid'], attack_technique_name=attack_technique_name,
+                             report_uid=report_id, attack_tid=attack_uid['tid'],
+                             probability=sentence['ml_probabilities'].get(technique)))
+        return hits
 
     async def get_true_negs(self):
         true_negs = await self.dao.get('true_negatives')
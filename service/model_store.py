@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import shutil
+import logging
+from collections.abc import Mapping
+
+import joblib
+import sklearn
+
+
+class ModelStore:
+    """
+    Versioned directory of trained models. Each version holds a manifest.json and one joblib artifact per model,
+    and a CURRENT file names the live version:
+
+        <root>/CURRENT
+        <root>/<version>/manifest.json
+        <root>/<version>/0000.joblib ...
+
+    A version is written under a temporary name and renamed into place once complete, and CURRENT is swapped the
+    same way, so a build that dies part way through never replaces the live models.
+    """
+
+    def __init__(self, root='models/store', keep=3):
+        """
+        :param root: Directory the versions are kept in
+        :param keep: Number of versions to retain for rollback, including the live one
+        """
+        self.root = root
+        self.keep = max(1, int(keep))
+
+    def current_version(self):
+        try:
+            with open(os.path.join(self.root, 'CURRENT'), 'r') as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return version if os.path.isfile(os.path.join(self.root, version, 'manifest.json')) else None
+
+    def versions(self):
+        """:return: the complete versions in the store, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(v for v in os.listdir(self.root) if not v.startswith('.')
+                      and os.path.isfile(os.path.join(self.root, v, 'manifest.json')))
+
+    def manifest(self, version=None):
+        version = version or self.current_version()
+        if not version:
+            return None
+        with open(os.path.join(self.root, version, 'manifest.json'), 'r') as f:
+            return json.load(f)
+
+    def save(self, models, engine, fingerprint, metrics=None, fingerprints=None, reuse=()):
+        """
+        Write a new version and make it the live one
+        :param models: dictionary of model name to the object to store for it
+        :param engine: MLService engine the models were built by
+        :param fingerprint: digest of the training set the models were built from
+        :param metrics: dictionary of evaluation results to record in the manifest
+        :param fingerprints: dictionary of model name to the digest of its own training inputs
+        :param reuse: names of models to carry over unchanged from the live version
+        :return: the new version
+        """
+        live = self.manifest() if reuse else None
+        os.makedirs(self.root, exist_ok=True)
+        version = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        while os.path.exists(os.path.join(self.root, version)):
+            version = '{}.{}'.format(version.split('.')[0], int(time.time() * 1000) % 1000000)
+        staging = os.path.join(self.root, '.tmp-{}'.format(version))
+        os.makedirs(staging)
+        try:
+            artifacts = {}
+            for index, (name, model) in enumerate(models.items()):
+                artifacts[name] = '{:04d}.joblib'.format(index)
+                # uncompressed, so the arrays inside can be memory mapped when loaded
+                joblib.dump(model, os.path.join(staging, artifacts[name]))
+            for index, name in enumerate(reuse, len(artifacts)):
+                artifacts[name] = '{:04d}.joblib'.format(index)
+                _link(os.path.join(self.root, live['version'], live['artifacts'][name]),
+                      os.path.join(staging, artifacts[name]))
+            manifest = dict(version=version, engine=engine, fingerprint=fingerprint, created=time.time(),
+                            sklearn_version=sklearn.__version__, metrics=metrics or {}, artifacts=artifacts,
+                            fingerprints=fingerprints or {})
+            with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(staging, os.path.join(self.root, version))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.activate(version)
+        self.prune()
+        return version
+
+    def activate(self, version):
+        """Point CURRENT at a stored version, e.g. to roll back to an earlier build"""
+        if version not in self.versions():
+            raise ValueError('Unknown model version: {}'.format(version))
+        pointer = os.path.join(self.root, '.CURRENT.tmp')
+        with open(pointer, 'w') as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(self.root, 'CURRENT'))
+        logging.info('[#] Model version {} is live'.format(version))
+
+    def prune(self):
+        current = self.current_version()
+        versions = self.versions()
+        for version in versions[:max(0, len(versions) - self.keep)]:
+            if version != current:
+                shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+        if current and os.path.isdir(self.root):
+            # staging left by a save that died part way through. Versions are timestamps, so one named no later
+            # than the live version cannot belong to a save still in progress
+            for name in os.listdir(self.root):
+                if name.startswith('.tmp-') and name[len('.tmp-'):] <= current:
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def load(self, version=None):
+        """
+        :return: LazyModels over the given version, the live one by default, or None when the store is empty
+        """
+        manifest = self.manifest(version)
+        return LazyModels(os.path.join(self.root, manifest['version']), manifest) if manifest else None
+
+
+def _link(source, destination):
+    # artifacts are never modified once written, so versions can share one file
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class LazyModels(Mapping):
+    """Read-only mapping of model name to model, loading each artifact the first time it is looked up"""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self._loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            artifact = self.manifest['artifacts'][name]
+            self._loaded[name] = joblib.load(os.path.join(self.path, artifact), mmap_mode='r')
+        return self._loaded[name]
+
+    def __contains__(self, name):
+        return name in self.manifest['artifacts']
+
+    def __iter__(self):
+        return iter(self.manifest['artifacts'])
+
+    def __len__(self):
+        return len(self.manifest['artifacts'])
@@ -1,56 +1,436 @@
 import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import deque
+
+# longest regex pattern accepted from an analyst
+MAX_PATTERN_LENGTH = 1000
+
+# run in a separate interpreter, so a pattern that backtracks without end can be killed once it runs out of time.
+# It reads one JSON-encoded pattern per line and answers each once the pattern has been through every probe string
+_PROBE_SCRIPT = r"""
+import re, sys, json
+probes = []
+for ch in 'aA1 .-_/\\\t:x':
+    probes.extend([ch * 30 + '!', ch * 3000, (ch + ' ') * 1500, (ch + 'b') * 1500 + '!'])
+probes.append('The adversary used PowerShell to download and execute a payload from a remote server. ' * 40)
+for line in sys.stdin:
+    pattern = re.compile(json.loads(line), re.IGNORECASE)
+    for probe in probes:
+        pattern.search(probe)
+    print('ok', flush=True)
+"""
+
+
+# backreferences would point at the wrong group once folded into the combined alternation, while named groups
+# can collide and global inline flags are only allowed at its very start, so these patterns are matched on their own
+_UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?[aiLmsux]+\)')
+
+
+class PatternSet:
+    """
+    The regex_patterns rows compiled once. A combined alternation of every pattern finds the sentences any of
+    them can match in a single search per sentence, and only those are run against the patterns one at a time.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.key = hashlib.sha1(json.dumps([(r['uid'], r['attack_uid'], r['regex_pattern']) for r in rows])
+                                .encode('utf-8')).hexdigest()
+        self.patterns = []
+        for row in rows:
+            try:
+                compiled = re.compile(row['regex_pattern'], re.IGNORECASE)
+            except re.error as exc:
+                logging.warning('[!] Skipping regex pattern {}, it does not compile: {}'.format(row['uid'], exc))
+                continue
+            self.patterns.append((row, compiled, not _UNCOMBINABLE.search(row['regex_pattern'])))
+        self.prefilter = self._combine([compiled.pattern for _, compiled, combined in self.patterns if combined])
+
+    @staticmethod
+    def _combine(patterns):
+        if not patterns:
+            return None
+        try:
+            return re.compile('|'.join('(?:{})'.format(p) for p in patterns), re.IGNORECASE)
+        except (re.error, RecursionError, OverflowError) as exc:
+            logging.warning('[!] Regex patterns could not be combined, matching them one at a time: {}'.format(exc))
+            return None
+
+    def scan(self, texts, budget=None):
+        """
+        Function to match every pattern against every sentence
+        :param budget: seconds a pattern may spend on the document before it is skipped for its remaining sentences
+        :return: list per sentence of the matching pattern rows, and the stats of the scan: 'patterns' maps each
+                 pattern uid to its hit count, seconds spent matching and whether it ran out of budget, 'prefilter'
+                 holds the same for the combined alternation, counting the sentences it let through
+        """
+        found = [[] for _ in texts]
+        stats = dict(patterns={}, prefilter=None)
+        everything = range(len(texts))
+        candidates = everything
+        if self.prefilter:
+            start = time.perf_counter()
+            candidates, exhausted = self._prefilter(texts, budget)
+            stats['prefilter'] = (len(candidates), time.perf_counter() - start, exhausted)
+        for row, compiled, combined in self.patterns:
+            hits, exhausted = 0, False
+            start = time.perf_counter()
+            for i in candidates if combined else everything:
+                if compiled.search(texts[i]):
+                    found[i].append(row)
+                    hits += 1
+                if budget and time.perf_counter() - start > budget:
+                    exhausted = True
+                    break
+            stats['patterns'][row['uid']] = (hits, time.perf_counter() - start, exhausted)
+        return found, stats
+
+    def _prefilter(self, texts, budget=None):
+        """
+        :return: indexes of the sentences the combined alternation matches, plus any it had no time left for, and
+                 whether it ran out of budget
+        """
+        candidates = []
+        start = time.perf_counter()
+        for i, text in enumerate(texts):
+            if self.prefilter.search(text):
+                candidates.append(i)
+            if budget and time.perf_counter() - start > budget:
+                # the per-pattern pass has its own budgets, so a slow pattern can be skipped on its own there
+                logging.debug('[!] Regex prefilter ran out of its {}s budget'.format(budget))
+                return candidates + list(range(i + 1, len(texts))), True
+        return candidates, False
+
+
+# pattern sets built in an analysis worker, keyed by PatternSet.key
+_worker_patterns = {}
+
+
+def scan_sentences(key, rows, texts, budget=None):
+    """Analysis worker function to match a document against the pattern set, compiling it once per worker"""
+    pattern_set = _worker_patterns.get(key)
+    if pattern_set is None:
+        pattern_set = PatternSet(rows)
+        # a thread pool shares this dictionary, so keep the local reference rather than look the key up again
+        _worker_patterns.clear()
+        _worker_patterns[key] = pattern_set
+    return pattern_set.scan(texts, budget)
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over the similar_words keywords (technique and software names and aliases), finding
+    every keyword in a text in one case-insensitive pass however many keywords there are
+    """
+
+    def __init__(self, rows, min_length=4):
+        """
+        :param rows: dictionaries of attack_uid and similar_word
+        :param min_length: shorter keywords are left out, as they match too much ordinary text
+        """
+        self.rows = rows
+        self.key = hashlib.sha1(json.dumps([(r['attack_uid'], r['similar_word']) for r in rows] + [min_length])
+                                .encode('utf-8')).hexdigest()
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        for row in rows:
+            word = (row['similar_word'] or '').strip().lower()
+            if len(word) < min_length:
+                continue
+            node = 0
+            for ch in word:
+                if ch not in self.goto[node]:
+                    self.goto[node][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = self.goto[node][ch]
+            if (len(word), row['attack_uid']) not in self.out[node]:
+                self.out[node].append((len(word), row['attack_uid']))
+        # breadth first, so a node's failure link (its longest proper suffix in the trie) is set before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text):
+        """:return: attack uids of the keywords found in the text as whole words, in order of first appearance"""
+        text = text.lower()
+        found = []
+        node = 0
+        for end, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, attack_uid in self.out[node]:
+                if attack_uid not in found and _boundary(text, end - length) and _boundary(text, end + 1):
+                    found.append(attack_uid)
+        return found
+
+
+def _boundary(text, index):
+    return index < 0 or index >= len(text) or not (text[index].isalnum() or text[index] == '_')
+
+
+# keyword automatons built in an analysis worker, keyed by KeywordAutomaton.key
+_worker_keywords = {}
+
+
+def match_keywords(key, rows, min_length, texts):
+    """Analysis worker function to find the similar_words keywords in each sentence, building the automaton once"""
+    automaton = _worker_keywords.get(key)
+    if automaton is None:
+        automaton = KeywordAutomaton(rows, min_length)
+        _worker_keywords.clear()
+        _worker_keywords[key] = automaton
+    return [automaton.search(text) for text in texts]
 
 
 class RegService:
 
     # Service to analyze the text file against the attack-dict to find matches
-    def __init__(self, dao):
+    def __init__(self, dao, data_svc, pool=None, min_keyword_length=4, pattern_budget=0.5, probe_timeout=2.0,
+                 profile_window=50):
+        """
+        :param pool: WorkerPool to run the regex scan in, it runs on the event loop without one
+        :param min_keyword_length: Shortest similar_words keyword to match
+        :param pattern_budget: Seconds one regex pattern may spend on a document before it is skipped for the rest
+        :param probe_timeout: Seconds a new regex pattern has to get through the backtracking probes
+        :param profile_window: Number of recent documents the regex profile covers
+        """
         self.dao = dao
+        self.data_svc = data_svc
+        self.pool = pool
+        self.pattern_set = None
+        self.pattern_generation = 0
+        self.pattern_lock = None
+        self.probed = {}  # pattern text to why it failed the probes, or None once it got through them
+        self.pattern_budget = pattern_budget
+        self.probe_timeout = probe_timeout
+        self.recent_scans = deque(maxlen=profile_window)
+        self.min_keyword_length = min_keyword_length
+        self.keywords = None
+        self.keyword_generation = 0
+        data_svc.on_catalog_change(self.invalidate_patterns)
+        data_svc.on_catalog_change(self.invalidate_keywords)
+
+    async def get_pattern_set(self):
+        """:return: the compiled regex_patterns, built the first time they are needed after a change"""
+        if self.pattern_lock is None:
+            self.pattern_lock = asyncio.Lock()
+        async with self.pattern_lock:
+            pattern_set = self.pattern_set
+            if pattern_set is None:
+                generation = self.pattern_generation
+                rows = await self.dao.get('regex_patterns')
+                pattern_set = PatternSet(await self.probed_rows(rows))
+                # a change that lands while the rows are read leaves this set out of date, so only cache it otherwise
+                if generation == self.pattern_generation:
+                    self.pattern_set = pattern_set
+        return pattern_set
+
+    async def probed_rows(self, rows):
+        """
+        Function to drop the regex_patterns rows whose pattern fails the backtracking probes, probing each pattern
+        the first time it is seen, so rows from the loaders or already in the table are checked like new ones
+        :return: the rows that are safe to scan with
+        """
+        unseen = []
+        for row in rows:
+            pattern = row['regex_pattern']
+            if pattern in self.probed or pattern in unseen:
+                continue
+            try:
+                re.compile(pattern, re.IGNORECASE)
+            except (re.error, TypeError):
+                # PatternSet skips and logs these itself
+                continue
+            unseen.append(pattern)
+        if unseen:
+            failed = await self.probe_patterns(unseen)
+            for pattern in unseen:
+                self.probed[pattern] = failed.get(pattern)
+        safe = []
+        for row in rows:
+            problem = self.probed.get(row['regex_pattern'])
+            if problem:
+                logging.warning('[!] Skipping regex pattern {}: {}'.format(row['uid'], problem))
+                continue
+            safe.append(row)
+        return safe
 
-    @classmethod
-    def find_techniques(self, jupyter_doc_markup, list_of_sentences, techniques_found, techniques, list_of_legacy):
-        for senid in range(0, len(jupyter_doc_markup)):
-            jupyter_doc_markup[senid], _, hit_names = self.similar_word_matcher(self, techniques,
-                                                                                jupyter_doc_markup[senid],
-                                                                                list_of_legacy)
-            if hit_names:
-                for hit in hit_names:
-                    sen = list_of_sentences[senid]
-                    if hit not in techniques_found[sen]:
-                        techniques_found[sen].append(hit)
-
-    def analyze_document(self, regex_pattern, sentence):
-        cleaned_sentence = sentence['text']
-        if re.findall(regex_pattern['regex_pattern'], cleaned_sentence, re.IGNORECASE):
-            print('Found {} in {}'.format(regex_pattern, cleaned_sentence))
-            return True
+    async def probe_patterns(self, patterns):
+        """
+        Function to run regex patterns against backtracking probe strings in a child interpreter, which is killed
+        and restarted for the rest whenever one pattern takes longer than probe_timeout, as a search cannot be
+        interrupted from inside Python
+        :return: dictionary of each pattern that failed to the reason why
+        """
+        failed = {}
+        pending = list(patterns)
+        while pending:
+            probe = await asyncio.create_subprocess_exec(sys.executable, '-c', _PROBE_SCRIPT,
+                                                         stdin=asyncio.subprocess.PIPE,
+                                                         stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.DEVNULL)
+            try:
+                while pending:
+                    probe.stdin.write((json.dumps(pending[0]) + '\n').encode('utf-8'))
+                    await probe.stdin.drain()
+                    if not await asyncio.wait_for(probe.stdout.readline(), self.probe_timeout):
+                        # the child died on this pattern, e.g. by running out of stack
+                        failed[pending.pop(0)] = 'Regex pattern failed on the test strings.'
+                        break
+                    pending.pop(0)
+            except asyncio.TimeoutError:
+                failed[pending.pop(0)] = 'Regex pattern took over {}s on the test strings, it probably backtracks ' \
+                                         'catastrophically.'.format(self.probe_timeout)
+            except (BrokenPipeError, ConnectionResetError):
+                failed[pending.pop(0)] = 'Regex pattern failed on the test strings.'
+            finally:
+                if probe.returncode is None:
+                    probe.kill()
+                await probe.wait()
+        return failed
+
+    def invalidate_patterns(self):
+        self.pattern_set = None
+        self.pattern_generation += 1
+
+    async def get_keywords(self):
+        """:return: the similar_words keyword automaton, built the first time it is needed after a change"""
+        keywords = self.keywords
+        if keywords is None:
+            generation = self.keyword_generation
+            # rows loaded by insert_attack_stix_data before attack_uid was filled in carry the technique in uid
+            rows = await self.dao.raw_select('SELECT COALESCE(attack_uid, uid) AS attack_uid, similar_word '
+                                             'FROM similar_words ORDER BY rowid')
+            keywords = KeywordAutomaton(rows, self.min_keyword_length)
+            # as for the pattern set, only cache it if similar_words did not change while it was read
+            if generation == self.keyword_generation:
+                self.keywords = keywords
+        return keywords
+
+    def invalidate_keywords(self):
+        self.keywords = None
+        self.keyword_generation += 1
+
+    async def analyze_html(self, html_sentences):
+        pattern_set = await self.get_pattern_set()
+        texts = [sentence['text'] for sentence in html_sentences]
+        if self.pool:
+            found, stats = await self.pool.run(scan_sentences, pattern_set.key, pattern_set.rows, texts,
+                                               self.pattern_budget)
         else:
-            return False
-
-    @classmethod
-    def analyze_html(self, regex_patterns, html_sentences):
-        for regex_pattern in regex_patterns:
-            count = 0
-            for sentence in html_sentences:
-                sentence_analysis = self.analyze_document(self, regex_pattern, sentence)
-                if sentence_analysis:
-                    html_sentences[count]['reg_techniques_found'].append(regex_pattern['attack_uid'])
-                count += 1
+            found, stats = pattern_set.scan(texts, self.pattern_budget)
+        keywords = await self.get_keywords()
+        if self.pool:
+            keyword_hits = await self.pool.run(match_keywords, keywords.key, keywords.rows,
+                                               self.min_keyword_length, texts)
+        else:
+            keyword_hits = [keywords.search(text) for text in texts]
+        for sentence, rows, attack_uids in zip(html_sentences, found, keyword_hits):
+            for row in rows:
+                logging.debug('[#] Regex pattern {} matched: {}'.format(row['uid'], sentence['text'][:120]))
+                sentence['reg_techniques_found'].append(row['attack_uid'])
+            for attack_uid in attack_uids:
+                if attack_uid not in sentence['reg_techniques_found']:
+                    sentence['reg_techniques_found'].append(attack_uid)
+        for uid, (hits, seconds, exhausted) in stats['patterns'].items():
+            if exhausted:
+                logging.warning('[!] Regex pattern {} ran out of its {}s budget, skipped for the rest of the document'
+                                .format(uid, self.pattern_budget))
+        self.recent_scans.append(stats)
         return html_sentences
 
+    async def validate_pattern(self, regex_pattern):
+        """
+        Function to check an analyst's regex pattern before it is stored
+        :return: None if the pattern is safe to run, otherwise the reason it was rejected
+        """
+        if not regex_pattern:
+            return 'Please enter a regex pattern.'
+        if len(regex_pattern) > MAX_PATTERN_LENGTH:
+            return 'Regex pattern is longer than {} characters.'.format(MAX_PATTERN_LENGTH)
+        try:
+            re.compile(regex_pattern, re.IGNORECASE)
+        except re.error as exc:
+            return 'Regex pattern does not compile: {}'.format(exc)
+        if regex_pattern not in self.probed:
+            failed = await self.probe_patterns([regex_pattern])
+            self.probed[regex_pattern] = failed.get(regex_pattern)
+        return self.probed[regex_pattern]
+
+    async def insert_pattern(self, attack_uid, regex_pattern):
+        """
+        Function to validate and store a regex pattern for a technique
+        :return: dictionary of the status and, when stored, the new pattern's uid
+        """
+        problem = await self.validate_pattern(regex_pattern)
+        if problem:
+            return dict(status=problem)
+        if not await self.data_svc.resolve_technique(attack_uid, keys=('uid',)):
+            return dict(status='Unknown technique: {}'.format(attack_uid))
+        uid = await self.dao.insert('regex_patterns', dict(attack_uid=attack_uid, regex_pattern=regex_pattern))
+        self.invalidate_patterns()
+        return dict(status='Regex pattern {} inserted'.format(uid), uid=uid)
+
+    async def regex_profile(self, limit=20):
+        """
+        Function to report the slowest regex patterns over the recently analyzed documents
+        :return: dictionary of 'patterns', the slowest patterns with their total and per document time, hits and
+                 times out of budget, and 'prefilter', the same for the combined alternation that runs before them
+        """
+        totals = {}
+        prefilter = dict(seconds=0.0, sentences=0, documents=0, exhausted=0)
+        for stats in self.recent_scans:
+            if stats['prefilter']:
+                sentences, seconds, exhausted = stats['prefilter']
+                prefilter['seconds'] += seconds
+                prefilter['sentences'] += sentences
+                prefilter['documents'] += 1
+                prefilter['exhausted'] += int(exhausted)
+            for uid, (hits, seconds, exhausted) in stats['patterns'].items():
+                total = totals.setdefault(uid, dict(uid=uid, seconds=0.0, hits=0, documents=0, exhausted=0))
+                total['seconds'] += seconds
+                total['hits'] += hits
+                total['documents'] += 1
+                total['exhausted'] += int(exhausted)
+        rows = {row['uid']: row for row in (await self.get_pattern_set()).rows}
+        profile = sorted(totals.values(), key=lambda total: total['seconds'], reverse=True)[:limit]
+        for total in profile:
+            total['attack_uid'] = rows.get(total['uid'], {}).get('attack_uid')
+            total['regex_pattern'] = rows.get(total['uid'], {}).get('regex_pattern')
+            total['ms_per_document'] = round(1000 * total['seconds'] / total['documents'], 3)
+        if prefilter['documents']:
+            prefilter['ms_per_document'] = round(1000 * prefilter['seconds'] / prefilter['documents'], 3)
+        return dict(patterns=profile, prefilter=prefilter)
+
     async def reg_techniques_found(self, report_id, sentence):
-        sentence_id = await self.dao.insert('report_sentences',
-                                            dict(report_uid=report_id, text=sentence['text'],
-                                                 html=sentence['html'], found_status="true"))
+        """
+        Function to build the report_sentence_hits rows for the regex techniques found in a sentence
+        :param report_id: uid of the report the sentence belongs to
+        :param sentence: Analyzed sentence dictionary
+        :return: list of hit rows, keyed to the sentence once it has been inserted
+        """
+        hits = []
         for technique in sentence['reg_techniques_found']:
-            attack_uid = await self.dao.get('attack_uids', dict(name=technique))
+            attack_uid = await self.data_svc.resolve_technique(technique)
             if not attack_uid:
-                attack_uid = await self.dao.get('attack_uids', dict(tid=technique))
-                if not attack_uid:
-                    attack_uid = await self.dao.get('attack_uids', dict(uid=technique))
-            attack_technique = attack_uid[0]['uid']
-            attack_technique_name = '{} (r)'.format(attack_uid[0]['name'])
-            attack_tid = attack_uid[0]['tid']
-            await self.dao.insert('report_sentence_hits',
-                                  dict(uid=sentence_id, attack_uid=attack_technique,
-                                       attack_technique_name=attack_technique_name, report_uid=report_id, attack_tid = attack_tid))
\ No newline at end of file
+                logging.warning('[!] Regex technique {} is not in attack_uids, skipping'.format(technique))
+                continue
+            attack_technique_name = '{} (r)'.format(attack_uid['name'])
+            # regex matches carry no probability, but share the ML hits' columns for the batched insert
+            hits.append(dict(attack_uid=attack_uid['uid'], attack_technique_name=attack_technique_name,
+                             report_uid=report_id, attack_tid=attack_uid['tid'], probability=None))
+        return hits
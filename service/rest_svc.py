@@ -1,36 +1,93 @@
-import json
+import time
 import asyncio
+import logging
 from io import StringIO
 import pandas as pd
 
 class RestService:
 
-    def __init__(self, web_svc, reg_svc, data_svc, ml_svc, dao):
+    def __init__(self, web_svc, reg_svc, data_svc, ml_svc, dao, queue_workers=1):
+        """
+        :param queue_workers: Number of reports analyzed at the same time
+        """
         self.dao = dao
         self.data_svc = data_svc
         self.web_svc = web_svc
         self.ml_svc = ml_svc
         self.reg_svc = reg_svc
         self.queue = asyncio.Queue() # task queue
-        self.resources = [] # resource array
+        self.queue_workers = max(1, int(queue_workers))
+        self.workers = []  # long-running tasks taking reports off the queue
+        self.queued = {}  # report id to the report waiting for a worker, in queue order
+        self.active = {}  # report id to the report being analyzed and its task
+        self.cancelled = set()  # ids of queued reports to skip once they come off the queue
 
     async def false_negative(self, criteria=None):
         sentence_dict = await self.dao.get('report_sentences', dict(uid=criteria['sentence_id']))
         sentence_to_strip = sentence_dict[0]['text']
-        sentence_to_insert = self.web_svc.remove_html_markup_and_found(sentence_to_strip)
+        sentence_to_insert = await self.web_svc.remove_html_markup_and_found(sentence_to_strip)
         await self.dao.insert('false_negatives', dict(sentence_id=sentence_dict[0]['uid'], uid=criteria['attack_uid'],
-                                                      false_negative=sentence_to_insert))
+                                                      false_negative=sentence_to_insert,
+                                                      **self.data_svc.token_columns(sentence_to_insert)))
         return dict(status='inserted')
 
     async def set_status(self, criteria=None):
         report_dict = await self.dao.get('reports', dict(title=criteria['file_name']))
         await self.dao.update('reports', 'uid', report_dict[0]['uid'], dict(current_status=criteria['set_status']))
+        self.data_svc.invalidate_report_board()
         return dict(status="Report status updated to " + criteria['set_status'])
 
     async def delete_report(self, criteria=None):
-        await self.dao.delete('reports', dict(uid=criteria['report_id']))
-        await self.dao.delete('report_sentences', dict(report_uid=criteria['report_id']))
-        await self.dao.delete('report_sentence_hits', dict(report_uid=criteria['report_id']))
+        await self._cancel(int(criteria['report_id']))
+        await self.data_svc.delete_report(criteria['report_id'])
+
+    async def cancel_analysis(self, criteria=None):
+        """Function to stop a queued or running analysis and delete its report"""
+        report_id = int(criteria['report_id'])
+        if not await self._cancel(report_id):
+            return dict(status='Report {} is not queued or being analyzed'.format(report_id))
+        await self.data_svc.delete_report(report_id)
+        return dict(status='Analysis of report {} cancelled'.format(report_id))
+
+    async def queue_status(self, criteria=None):
+        now = time.time()
+        active = [dict(id=report_id, title=job['title'], url=job['url'], seconds=round(now - job['started'], 1))
+                  for report_id, job in self.active.items()]
+        queued = [dict(id=report_id, title=report['title'], url=report['url'])
+                  for report_id, report in self.queued.items()]
+        return dict(status='{} active, {} queued'.format(len(active), len(queued)), workers=len(self.workers),
+                    active=active, queued=queued)
+
+    async def compact_database(self, criteria=None):
+        result = await self.data_svc.compact_database()
+        return dict(status='Database compacted from {bytes_before} to {bytes_after} bytes'.format(**result))
+
+    async def search(self, criteria=None):
+        if not criteria.get('query'):
+            return dict(status='Please enter a search phrase.', matches=[])
+        matches = await self.data_svc.search_text(criteria['query'], scope=criteria.get('scope', 'all'),
+                                                  limit=int(criteria.get('limit', 50)))
+        return dict(status='{} matches'.format(len(matches)), matches=matches)
+
+    async def build_status(self, criteria=None):
+        return dict(self.ml_svc.build_status, workers=self.ml_svc.workers)
+
+    async def model_version(self, criteria=None):
+        resident = self.ml_svc.resident
+        if not resident:
+            return dict(status='No models are loaded yet', version=None)
+        manifest = resident['manifest']
+        return dict(status='Model version {} is live'.format(resident['version']), version=resident['version'],
+                    engine=manifest['engine'], fingerprint=manifest['fingerprint'], created=manifest['created'],
+                    loaded=resident['loaded'], techniques=len(resident['list_of_techs']))
+
+    async def insert_regex_pattern(self, criteria=None):
+        return await self.reg_svc.insert_pattern(criteria.get('attack_uid'), criteria.get('regex_pattern'))
+
+    async def regex_profile(self, criteria=None):
+        criteria = criteria or {}
+        profile = await self.reg_svc.regex_profile(limit=int(criteria.get('limit', 20)))
+        return dict(status='{} documents profiled'.format(len(self.reg_svc.recent_scans)), **profile)
 
     async def remove_sentences(self, criteria=None):
         if not criteria['sentence_id']:
@@ -60,15 +117,17 @@ class RestService:
         techniques = await self.dao.get('true_positives',
                                         dict(sentence_id=criteria['sentence_id'], element_tag=criteria['element_tag']))
         for tech in techniques:
-            name = await self.dao.get('attack_uids', dict(uid=tech['uid']))
-            tmp.append(name[0])
+            name = await self.data_svc.resolve_technique(tech['uid'], keys=('uid',))
+            if name:
+                tmp.append(name)
         return tmp
 
     async def true_positive(self, criteria=None):
         sentence_dict = await self.dao.get('report_sentences', dict(uid=criteria['sentence_id']))
         sentence_to_insert = await self.web_svc.remove_html_markup_and_found(sentence_dict[0]['text'])
         await self.dao.insert('true_positives', dict(sentence_id=sentence_dict[0]['uid'], uid=criteria['attack_uid'],
-                                                    true_positive=sentence_to_insert, element_tag=criteria['element_tag']))
+                                                    true_positive=sentence_to_insert, element_tag=criteria['element_tag'],
+                                                    **self.data_svc.token_columns(sentence_to_insert)))
         return dict(status='inserted')
 
     async def false_positive(self, criteria=None):
@@ -76,7 +135,8 @@ class RestService:
         sentence_to_insert = await self.web_svc.remove_html_markup_and_found(sentence_dict[0]['text'])
         last = await self.data_svc.last_technique_check(criteria)
         await self.dao.insert('false_positives', dict(sentence_id=sentence_dict[0]['uid'], uid=criteria['attack_uid'],
-                                                      false_positive=sentence_to_insert))
+                                                      false_positive=sentence_to_insert,
+                                                      **self.data_svc.token_columns(sentence_to_insert)))
         return dict(status='inserted', last=last)
 
     async def insert_report(self, criteria=None):
@@ -85,11 +145,9 @@ class RestService:
         for i in range(len(criteria['title'])):
             temp_dict = dict(title=criteria['title'][i], url=criteria['url'][i],current_status="queue")
             temp_dict['id'] = await self.dao.insert('reports', temp_dict)
-            await self.queue.put(temp_dict)
-        # criteria = dict(title=criteria['title'], url=criteria['url'],current_status="needs_review")
-        # await self.queue.put(criteria)
-        asyncio.create_task(self.check_queue()) # check queue background task
-        await asyncio.sleep(0.01)
+            await self._enqueue(temp_dict)
+        self.data_svc.invalidate_report_board()
+        self.start_workers()
 
     async def insert_csv(self,criteria=None):
         file = StringIO(criteria['file'])
@@ -97,105 +155,117 @@ class RestService:
         for row in range(df.shape[0]):
             temp_dict = dict(title=df['title'][row],url=df['url'][row],current_status="queue")
             temp_dict['id'] = await self.dao.insert('reports', temp_dict)
-            await self.queue.put(temp_dict)
-        asyncio.create_task(self.check_queue())
-        await asyncio.sleep(0.01)
-
-    async def check_queue(self):
-        '''
-        description: executes as concurrent job, manages taking jobs off the queue and executing them.
-        If a job is already being processed, wait until that job is done, then execute next job on queue.
-        input: nil
-        output: nil
-        '''
-        for task in range(len(self.resources)):  # check resources for finished tasks
-            if self.resources[task].done():
-                del self.resources[task]  # delete finished tasks
-
-        max_tasks = 1
-        while self.queue.qsize() > 0:  # while there are still tasks to do....
-            await asyncio.sleep(0.01)  # check resources and execute tasks
-            if len(self.resources) >= max_tasks:  # if the resource pool is maxed out...
-                while len(self.resources) >= max_tasks:  # check resource pool until a task is finished
-                    for task in range(len(self.resources)):
-                        if self.resources[task].done():
-                            del self.resources[task]  # when task is finished, remove from resource pool
-                    await asyncio.sleep(1)  # allow other tasks to run while waiting
-                criteria = await self.queue.get()  # get next task off queue, and run it
-                task = asyncio.create_task(self.start_analysis(criteria))
-                self.resources.append(task)
-            else:
-                criteria = await self.queue.get() # get next task off queue and run it
-                task = asyncio.create_task(self.start_analysis(criteria))
-                self.resources.append(task)
+            await self._enqueue(temp_dict)
+        self.data_svc.invalidate_report_board()
+        self.start_workers()
+
+    def start_workers(self):
+        """
+        Function to start the queue workers, each analyzes one report at a time. Downloads to any one site are
+        capped by the web service's fetcher, however many workers there are.
+        """
+        self.workers = [worker for worker in self.workers if not worker.done()]
+        for _ in range(self.queue_workers - len(self.workers)):
+            self.workers.append(asyncio.ensure_future(self._queue_worker()))
+
+    async def _enqueue(self, report):
+        self.queued[report['id']] = report
+        await self.queue.put(report)
+
+    async def _queue_worker(self):
+        while True:
+            criteria = await self.queue.get()
+            report_id = criteria['id']
+            try:
+                self.queued.pop(report_id, None)
+                if report_id in self.cancelled:
+                    continue
+                task = asyncio.ensure_future(self.start_analysis(criteria))
+                self.active[report_id] = dict(title=criteria['title'], url=criteria['url'], started=time.time(),
+                                              task=task)
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    # only swallow a cancel aimed at this report, not one stopping the worker itself
+                    if report_id not in self.cancelled:
+                        raise
+                    logging.info('[#] Analysis of report {} cancelled'.format(report_id))
+                except Exception:
+                    logging.exception('[!] Analysis of report {} ({}) failed'.format(report_id, criteria['url']))
+            finally:
+                self.active.pop(report_id, None)
+                self.cancelled.discard(report_id)
+                self.queue.task_done()
+
+    async def _cancel(self, report_id):
+        """:return: whether the report was queued or being analyzed"""
+        if report_id in self.queued:
+            self.queued.pop(report_id)
+            self.cancelled.add(report_id)
+            return True
+        if report_id in self.active:
+            self.cancelled.add(report_id)
+            task = self.active[report_id]['task']
+            task.cancel()
+            # wait for it to stop, so nothing it was in the middle of writing lands after the report is deleted
+            await asyncio.wait((task,))
+            return True
+        return False
 
     async def start_analysis(self, criteria=None):
-        tech_data = await self.dao.get('attack_uids')
-        json_tech = json.load(open("models/attack_dict.json", "r", encoding="utf_8"))
-        techniques = {}
-        for row in tech_data:
-            await asyncio.sleep(0.01)
-            # skip software
-            if 'tool' in row['tid'] or 'malware' in row['tid']:
-                continue
-            else:
-                # query for true positives
-                true_pos = await self.dao.get('true_positives', dict(uid=row['uid']))
-                tp, fp = [], []
-                for t in true_pos:
-                    tp.append(t['true_positive'])
-                # query for false negatives
-                false_neg = await self.dao.get('false_negatives', dict(uid=row['uid']))
-                for f in false_neg:
-                    tp.append(f['false_negative'])
-                # query for false positives for this technique
-                false_positives = await self.dao.get('false_positives', dict(uid=row['uid']))
-                for fps in false_positives:
-                    fp.append(fps['false_positive'])
-
-                techniques[row['uid']] = {'id': row['tid'], 'name': row['name'], 'similar_words': [],
-                                          'example_uses': tp, 'false_positives': fp}
-
-        html_data = await self.web_svc.get_url(criteria['url'])
-        original_html = await self.web_svc.map_all_html(criteria['url'])
+        # the models and technique lists are loaded once and shared by every analysis
+        resident = await self.ml_svc.get_resident()
+        list_of_techs = resident['list_of_techs']
+
+        # download the page once and hand the same html to both the text extraction and the html mapping
+        page = await self.web_svc.fetch(criteria['url'])
+        html_data = await self.web_svc.get_url(criteria['url'], html=page)
+        original_html = await self.web_svc.map_all_html(criteria['url'], html=page)
 
         article = dict(title=criteria['title'], html_text=html_data)
-        list_of_legacy, list_of_techs = await self.data_svc.ml_reg_split(json_tech)
 
-        true_negatives = await self.ml_svc.get_true_negs()
         # Here we build the sentence dictionary
         html_sentences = await self.web_svc.tokenize_sentence(article['html_text'])
-        model_dict = await self.ml_svc.build_pickle_file(list_of_techs, json_tech, true_negatives)
 
-        ml_analyzed_html = await self.ml_svc.analyze_html(list_of_techs, model_dict, html_sentences)
-        regex_patterns = await self.dao.get('regex_patterns')
-        reg_analyzed_html = self.reg_svc.analyze_html(regex_patterns, html_sentences)
+        ml_analyzed_html = await self.ml_svc.analyze_html(list_of_techs, resident['models'], html_sentences,
+                                                          version=resident['version'])
+        reg_analyzed_html = await self.reg_svc.analyze_html(html_sentences)
 
         # Merge ML and Reg hits
         analyzed_html = await self.ml_svc.combine_ml_reg(ml_analyzed_html, reg_analyzed_html)
 
-        # update card to reflect the end of queue
-        await self.dao.update('reports', 'title', criteria['title'], dict(current_status='needs_review'))
-        temp = await self.dao.get('reports',dict(title=criteria['title']))
+        temp = await self.dao.get('reports', dict(title=criteria['title']))
         criteria['id'] = temp[0]['uid']
-        # criteria['id'] = await self.dao.update('reports', dict(title=criteria['title'], url=criteria['url'],current_status="needs_review"))
         report_id = criteria['id']
+
+        # Build every row first so the write transaction only holds the database for the inserts themselves
+        sentence_rows, hit_rows = [], []
         for sentence in analyzed_html:
             if sentence['ml_techniques_found']:
-                await self.ml_svc.ml_techniques_found(report_id, sentence)
+                hits = await self.ml_svc.ml_techniques_found(report_id, sentence)
             elif sentence['reg_techniques_found']:
-                await self.reg_svc.reg_techniques_found(report_id, sentence)
+                hits = await self.reg_svc.reg_techniques_found(report_id, sentence)
             else:
-                data = dict(report_uid=report_id, text=sentence['text'], html=sentence['html'], found_status="false")
-                await self.dao.insert('report_sentences', data)
+                hits = []
+            sentence_rows.append(dict(report_uid=report_id, text=sentence['text'], html=sentence['html'],
+                                      found_status='true' if hits else 'false'))
+            hit_rows.append(hits)
+        html_rows = [dict(report_uid=report_id, text=element['text'], tag=element['tag'], found_status='false')
+                     for element in original_html]
 
-        for element in original_html:
-            html_element = dict(report_uid=report_id, text=element['text'], tag=element['tag'], found_status="false")
-            await self.dao.insert('original_html', html_element)
+        async with self.dao.transaction() as tx:
+            sentence_ids = await tx.insert_many('report_sentences', sentence_rows)
+            hits = [dict(hit, uid=sentence_id) for sentence_id, sentence_hits in zip(sentence_ids, hit_rows)
+                    for hit in sentence_hits]
+            await tx.insert_many('report_sentence_hits', hits)
+            await tx.insert_many('original_html', html_rows)
+            # update card to reflect the end of queue
+            await tx.update('reports', 'uid', report_id, dict(current_status='needs_review'))
+        self.data_svc.invalidate_report_board()
 
     async def missing_technique(self, criteria=None):
         # Get the attack information for this attack id
-        attack_dict = await self.dao.get('attack_uids', dict(uid=criteria['attack_uid']))
+        attack_dict = await self.data_svc.resolve_technique(criteria['attack_uid'], keys=('uid',))
 
         # Get the report sentence information for the sentence id
         sentence_dict = await self.dao.get('report_sentences', dict(uid=criteria['sentence_id']))
@@ -207,15 +277,16 @@ class RestService:
         await self.dao.insert('true_positives', dict(sentence_id=sentence_dict[0]['uid'],
                                                      uid=criteria['attack_uid'],
                                                      true_positive=sentence_to_insert,
-                                                     element_tag=criteria['element_tag']))
+                                                     element_tag=criteria['element_tag'],
+                                                     **self.data_svc.token_columns(sentence_to_insert)))
         
         # Insert new row in the report_sentence_hits database table to indicate a new confirmed technique
         # This is needed to ensure that requests to get all confirmed techniques works correctly
         await self.dao.insert('report_sentence_hits', dict(uid=criteria['sentence_id'],
                                                            attack_uid=criteria['attack_uid'],
-                                                           attack_technique_name=attack_dict[0]['name'],
+                                                           attack_technique_name=attack_dict['name'],
                                                            report_uid=sentence_dict[0]['report_uid'],
-                                                           attack_tid=attack_dict[0]['tid']))
+                                                           attack_tid=attack_dict['tid']))
         
         # If the found_status for the sentence id is set to false when adding a missing technique
         # then update the found_status value to true for the sentence id in the report_sentence table 
@@ -1,4 +1,3 @@
-import requests
 from nltk.corpus import stopwords
 import re
 import nltk
@@ -6,19 +5,93 @@ import newspaper
 from nltk.stem import SnowballStemmer
 from html2text import html2text
 from bs4 import BeautifulSoup
+from functools import lru_cache
 import asyncio
 
+from service.fetcher import Fetcher
+
+# bump whenever tokenize_text can give a different result, so anything stored from the old version is recomputed
+TOKENIZER_VERSION = 1
+
+_WORDS = re.compile(r'\w+')
+
+
+@lru_cache(maxsize=None)
+def _stopwords():
+    return frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=None)
+def _stemmer():
+    return SnowballStemmer('english')
+
+
+@lru_cache(maxsize=100000)
+def _stem(word):
+    return _stemmer().stem(word)
+
+
+def tokenize_text(s):
+    """Function to remove stopwords from a sentence and return its stemmed words joined by spaces"""
+    stop = _stopwords()
+    return ' '.join(_stem(word) for word in _WORDS.findall(s.lower()) if word not in stop)
+
+
+@lru_cache(maxsize=None)
+def _sentence_tokenizer():
+    return nltk.data.load('tokenizers/punkt/english.pickle')
+
+
+def split_sentences(data):
+    """Function to split a document into the sentence dictionaries that get analyzed"""
+    sentences = []
+    for html in _sentence_tokenizer().tokenize(data):
+        sentences.append(dict(html=html, text=html2text(html), ml_techniques_found=[], ml_probabilities={},
+                              reg_techniques_found=[]))
+    return sentences
+
+
+def extract_fulltext(html):
+    """Function to pull the article text out of a downloaded page"""
+    b = newspaper.fulltext(html)
+    return str(b).replace('\n', '<br>') if b else None
+
+
+def parse_article(url, html):
+    """Function to parse a downloaded page, returning its images, plain text and article html"""
+    a = newspaper.Article(url, keep_article_html=True)
+    a.download(input_html=html)
+    a.parse()
+    return list(a.images), a.text, a.article_html
+
 
 class WebService:
 
-    async def map_all_html(self, url_input):
-        a = newspaper.Article(url_input, keep_article_html=True)
-        a.download()
-        a.parse()
+    def __init__(self, pool=None, fetcher=None):
+        """
+        :param pool: WorkerPool to parse documents in, they are parsed on the event loop without one
+        :param fetcher: Fetcher to download report pages with
+        """
+        self.pool = pool
+        self.fetcher = fetcher or Fetcher()
+
+    async def _run(self, func, *args):
+        if self.pool:
+            return await self.pool.run(func, *args)
+        return func(*args)
+
+    async def fetch(self, url):
+        """Function to download a page once, so its html can be handed to both get_url and map_all_html"""
+        return await self.fetcher.fetch(url)
+
+    async def map_all_html(self, url_input, html=None):
+        if html is None:
+            html = await self.fetch(url_input)
+        article_images, article_text, article_html = await self._run(parse_article, url_input, html)
         results, plaintext, htmltext, images, seen_images = [], [], [], [], []
-        images = await self._collect_all_images(a.images)
-        plaintext = await self._extract_text_as_list(a.text)
-        htmltext = await self._extract_html_as_list(a.article_html)
+        images = await self._collect_all_images(article_images)
+        plaintext = await self._extract_text_as_list(article_text)
+        htmltext = await self._extract_html_as_list(article_html)
 
         # Loop through pt one by one, matching its line with a forward-advancing pointer on the html
         counter = 0
@@ -81,37 +154,21 @@ class WebService:
                         break
         return final_html
 
-    @staticmethod
-    async def tokenize_sentence(data):
+    async def tokenize_sentence(self, data):
         """
         :criteria: expects a dictionary of this structure:
         """
-        tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-        html = tokenizer.tokenize(data)
-        sentences = []
-        position = 0
-        for data in html:
-            position += 1
-            sentence_data = dict()
-            sentence_data['html'] = data
-            sentence_data['text'] = html2text(data)
-            sentence_data['ml_techniques_found'] = []
-            sentence_data['reg_techniques_found'] = []
-            sentences.append(sentence_data)
-        return sentences
+        return await self._run(split_sentences, data)
 
     @staticmethod
     async def tokenize(s):
         """Function to remove stopwords from a sentence and return a list of words to match"""
-        word_list = re.findall(r'\w+', s.lower())
-        filtered_words = [word for word in word_list if word not in stopwords.words('english')]
-        """Perform NLP Lemmatization and Stemming methods"""
-        lemmed = []
-        stemmer = SnowballStemmer('english')
-        for i in filtered_words:
-            await asyncio.sleep(0.001)
-            lemmed.append(stemmer.stem(str(i)))
-        return ' '.join(lemmed)
+        return tokenize_text(s)
+
+    @staticmethod
+    def tokenize_batch(texts):
+        """Function to tokenize a list of texts in one call, returning their tokenized forms in the same order"""
+        return [tokenize_text(s) for s in texts]
 
     @staticmethod
     async def remove_html_markup_and_found(s):
@@ -131,15 +188,12 @@ class WebService:
         out = out.split(sep, 1)[0]
         return out
 
-    @staticmethod
-    async def get_url(url, returned_format=None):
+    async def get_url(self, url, returned_format=None, html=None):
         if returned_format == 'html':
             print('[!] HTML support is being refactored. Currently data is being returned plaintext')
-        r = requests.get(url)
-        await asyncio.sleep(0.01)
-
-        b = newspaper.fulltext(r.text)
-        return str(b).replace('\n', '<br>') if b else None
+        if html is None:
+            html = await self.fetch(url)
+        return await self._run(extract_fulltext, html)
 
     @staticmethod
     async def _build_final_image_dict(element):
@@ -0,0 +1,47 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class WorkerPool:
+    """
+    Executor for the CPU-bound analysis stages, so parsing, tokenizing, scoring and the regex scan run off the
+    event loop. Functions handed to run() have to be module-level, as a process pool pickles them by name.
+    """
+
+    def __init__(self, kind='process', workers=None, initializer=None, initargs=()):
+        """
+        :param kind: 'process' for a process pool, 'thread' for a thread pool in the server process
+        :param workers: Number of workers, defaults to one per core
+        :param initializer: Called once in each worker as it starts, e.g. to preload the models
+        """
+        if kind not in ('process', 'thread'):
+            raise ValueError('Unknown worker pool kind: {}'.format(kind))
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executor = None
+
+    def _create(self):
+        if self.kind == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tram-analysis',
+                                      initializer=self.initializer, initargs=self.initargs)
+        # spawn rather than fork, as a child forked from the server could inherit a lock held by one of its threads
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=self.initializer, initargs=self.initargs)
+
+    async def run(self, func, *args):
+        """
+        Run func(*args) in the pool, starting the pool on first use
+        :return: func's return value
+        """
+        if self._executor is None:
+            self._executor = self._create()
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
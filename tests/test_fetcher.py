@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from service.fetcher import Fetcher, FetchError
+
+PAGE = '<html><body><p>The adversary ran café.exe</p></body></html>'
+
+
+def _stub_app(state):
+    """Stub site recording the requests made to it"""
+
+    async def page(request):
+        state['requests'] += 1
+        state['open'] += 1
+        state['peak'] = max(state['peak'], state['open'])
+        await asyncio.sleep(0.1)
+        state['open'] -= 1
+        return web.Response(text=PAGE, content_type='text/html', charset='utf-8')
+
+    async def flaky(request):
+        state['flaky'] += 1
+        if state['flaky'] < 3:
+            return web.Response(status=503)
+        return web.Response(text=PAGE, content_type='text/html')
+
+    async def missing(request):
+        state['missing'] += 1
+        return web.Response(status=404)
+
+    async def large(request):
+        return web.Response(body=b'x' * 4096)
+
+    async def streamed(request):
+        # no Content-Length, so the cap has to be enforced while reading
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(64):
+            await response.write(b'x' * 1024)
+        return response
+
+    async def slow(request):
+        state['slow'] += 1
+        await asyncio.sleep(5)
+        return web.Response(text=PAGE)
+
+    app = web.Application()
+    for path, handler in (('/page', page), ('/flaky', flaky), ('/missing', missing), ('/large', large),
+                          ('/streamed', streamed), ('/slow', slow)):
+        app.router.add_get(path, handler)
+    return app
+
+
+def _run(check, **options):
+    """Run check(fetcher, url, state) against a fresh stub site"""
+    state = dict(requests=0, open=0, peak=0, flaky=0, missing=0, slow=0)
+
+    async def run():
+        server = TestServer(_stub_app(state))
+        await server.start_server()
+        settings = dict(retries=3, backoff=0.01)
+        settings.update(options)
+        fetcher = Fetcher(**settings)
+        try:
+            await check(fetcher, lambda path: str(server.make_url(path)), state)
+        finally:
+            await fetcher.close()
+            await server.close()
+
+    asyncio.run(run())
+    return state
+
+
+def test_fetch_returns_decoded_page():
+    async def check(fetcher, url, state):
+        assert await fetcher.fetch(url('/page')) == PAGE
+
+    _run(check)
+
+
+def test_retries_unavailable_then_succeeds():
+    async def check(fetcher, url, state):
+        assert await fetcher.fetch(url('/flaky')) == PAGE
+
+    assert _run(check)['flaky'] == 3
+
+
+def test_client_error_is_not_retried():
+    async def check(fetcher, url, state):
+        with pytest.raises(FetchError, match='HTTP 404'):
+            await fetcher.fetch(url('/missing'))
+
+    assert _run(check)['missing'] == 1
+
+
+@pytest.mark.parametrize('path', ['/large', '/streamed'])
+def test_body_over_max_bytes_is_rejected(path):
+    async def check(fetcher, url, state):
+        with pytest.raises(FetchError, match='larger than'):
+            await fetcher.fetch(url(path))
+
+    _run(check, max_bytes=2048)
+
+
+def test_timeout_is_retried_then_fails():
+    async def check(fetcher, url, state):
+        with pytest.raises(FetchError, match='TimeoutError'):
+            await fetcher.fetch(url('/slow'))
+
+    assert _run(check, timeout=0.2, retries=1)['slow'] == 2
+
+
+def test_connections_per_host_are_capped():
+    async def check(fetcher, url, state):
+        pages = await asyncio.gather(*[fetcher.fetch(url('/page')) for _ in range(6)])
+        assert pages == [PAGE] * 6
+
+    state = _run(check, limit_per_host=2)
+    assert state['requests'] == 6
+    assert state['peak'] == 2
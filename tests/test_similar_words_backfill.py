@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+from database.dao import Dao
+from service.data_svc import DataService
+from service.reg_svc import RegService
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def _old_database(path):
+    """A database as the earlier JSON loader left it, with the catalog loaded but no similar_words"""
+    dao = Dao(path)
+    data_svc = DataService(dao=dao, web_svc=None)
+    await data_svc.reload_database(schema=os.path.join(ROOT, 'conf', 'schema.sql'))
+    await dao.insert('attack_uids', dict(uid='attack-pattern--1', description='d', tid='T1086', name='PowerShell'))
+    await dao.insert('attack_uids', dict(uid='malware--1', description='d', tid='malware--1', name='Emotet'))
+    await dao.insert('attack_uids', dict(uid='tool--1', description='d', tid='tool--1', name='Mimikatz'))
+    # loaded since the loader was fixed, so it has keywords of its own already
+    await dao.insert('attack_uids', dict(uid='tool--2', description='d', tid='tool--2', name='Cobalt Strike'))
+    await dao.insert('similar_words', dict(attack_uid='tool--2', similar_word='Beacon'))
+    return dao, data_svc
+
+
+def test_backfill_gives_old_databases_keywords(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+    async def run():
+        dao, data_svc = await _old_database(str(tmp_path / 'tram.db'))
+        reg_svc = RegService(dao, data_svc)
+        try:
+            assert (await reg_svc.get_keywords()).search('Emotet dropped Mimikatz') == []
+
+            assert await data_svc.backfill_similar_words() == 3
+            keywords = await reg_svc.get_keywords()
+            assert keywords.rows
+            assert keywords.search('Emotet dropped Mimikatz, then ran PowerShell') == [
+                'malware--1', 'tool--1', 'attack-pattern--1']
+            assert keywords.search('a Beacon was staged') == ['tool--2']
+
+            # nothing is added twice when it runs again on the next start
+            assert await data_svc.backfill_similar_words() == 0
+        finally:
+            await dao.close()
+
+    asyncio.run(run())
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import random
+
+from database.dao import Dao
+from service.data_svc import DataService
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def _old_training_techniques(dao):
+    """The per-technique construction get_training_techniques replaced in start_analysis and rebuild_ml"""
+    tech_data = await dao.get('attack_uids')
+    techniques = {}
+    for row in tech_data:
+        # skip software for now
+        if 'tool' in row['tid'] or 'malware' in row['tid']:
+            continue
+        else:
+            # query for true positives
+            true_pos = await dao.get('true_positives', dict(uid=row['uid']))
+            tp = []
+            for t in true_pos:
+                tp.append(t['true_positive'])
+            # query for false negatives and false positives
+            false_neg = await dao.get('false_negatives', dict(uid=row['uid']))
+            false_positives = await dao.get('false_positives', dict(uid=row['uid']))
+            for f in false_neg:
+                tp.append(f['false_negative'])
+            fp = []
+            for fps in false_positives:
+                fp.append(fps['false_positive'])
+
+            techniques[row['uid']] = {'id': row['tid'], 'name': row['name'], 'similar_words': [],
+                                      'example_uses': tp, 'false_positives': fp}
+    return techniques
+
+
+async def _build_database(path, seed):
+    dao = Dao(path)
+    data_svc = DataService(dao=dao, web_svc=None)
+    await data_svc.reload_database(schema=os.path.join(ROOT, 'conf', 'schema.sql'))
+    rng = random.Random(seed)
+    uids = []
+    for i in range(40):
+        uid = 'attack-pattern--{}'.format(i)
+        await dao.insert('attack_uids', dict(uid=uid, description='d', tid='T{}'.format(1000 + i),
+                                             name='Technique {}'.format(i)))
+        uids.append(uid)
+    for i in range(10):
+        # software shares the table, carrying its STIX id as the tid
+        kind = rng.choice(('tool', 'malware'))
+        uid = '{}--{}'.format(kind, i)
+        await dao.insert('attack_uids', dict(uid=uid, description='d', tid=uid, name='Software {}'.format(i)))
+        uids.append(uid)
+    # labelled rows in a random order, including rows for software and for uids missing from attack_uids
+    targets = uids + ['attack-pattern--orphan']
+    for i in range(600):
+        table, column = rng.choice((('true_positives', 'true_positive'), ('false_negatives', 'false_negative'),
+                                    ('false_positives', 'false_positive')))
+        await dao.insert(table, {'uid': rng.choice(targets), column: 'sentence {}'.format(i)})
+    return dao, data_svc
+
+
+def test_training_techniques_match_per_technique_construction(tmp_path, monkeypatch):
+    # migrations are looked up relative to the working directory
+    monkeypatch.chdir(ROOT)
+
+    async def run():
+        dao, data_svc = await _build_database(str(tmp_path / 'tram.db'), seed=4)
+        try:
+            new = await data_svc.get_training_techniques()
+            old = await _old_training_techniques(dao)
+        finally:
+            await dao.close()
+        return new, old
+
+    new, old = asyncio.run(run())
+    assert len(new) == 40
+    assert list(new) == list(old)
+    assert new == old
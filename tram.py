@@ -12,8 +12,11 @@ from handlers.web_api import WebAPI
 from service.data_svc import DataService
 from service.web_svc import WebService
 from service.reg_svc import RegService
-from service.ml_svc import MLService
+from service.ml_svc import MLService, preload_models
 from service.rest_svc import RestService
+from service.model_store import ModelStore
+from service.worker_pool import WorkerPool
+from service.fetcher import Fetcher
 
 from database.dao import Dao
 
@@ -40,6 +43,12 @@ async def background_tasks(taxii_local='online', build=False, json_file=None):
                 sys.exit()
         elif taxii_local == 'local-json' and json_file:
             await data_svc.insert_attack_json_data(json_file)
+    else:
+        await data_svc.migrate_database()
+    await data_svc.backfill_tokens()
+    await data_svc.backfill_similar_words()
+    # load the models once up front rather than when the first report is analyzed
+    await ml_svc.get_resident()
 
 
 @asyncio.coroutine
@@ -60,6 +69,7 @@ async def init(host, port):
     app.router.add_route('*', '/rest', website_handler.rest_api)
     app.router.add_route('GET', '/export/pdf/{file}', website_handler.pdf_export)
     app.router.add_route('GET', '/export/nav/{file}', website_handler.nav_export)
+    app.router.add_route('POST', '/rebuild', website_handler.rebuild_ml)
     app.router.add_static('/theme/', 'webapp/theme/')
 
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('webapp/html'))
@@ -69,32 +79,39 @@ async def init(host, port):
     await web.TCPSite(runner, host, port).start()
 
 
-def main(host, port, taxii_local=False, build=False, json_file=None):
+def main(host, port, taxii_local=False, build=False, json_file=None, compact_interval=0):
     """
     Main function to start app
     :param host: Address to reach webserver on
     :param port: Port to listen on
     :param on_off: Expects 'online' or 'offline' to specify the build type.
     :param json_file: Expects a path to the enterprise attack json if the 'offline' build method is called.
+    :param compact_interval: Hours between database compactions, 0 to only compact on request
     :return: nil
     """
     loop = asyncio.get_event_loop()
     loop.create_task(background_tasks(taxii_local=taxii_local, build=build, json_file=json_file))
+    if compact_interval:
+        loop.create_task(data_svc.schedule_compaction(compact_interval))
     loop.create_task(ml_svc.check_nltk_packs())
+    loop.call_soon(rest_svc.start_workers)
     loop.run_until_complete(init(host, port))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        loop.run_until_complete(web_svc.fetcher.close())
+        analysis_pool.shutdown()
+        loop.run_until_complete(dao.close())
 
 
 if __name__ == '__main__':
     logging.getLogger().setLevel('DEBUG')
     logging.info('Welcome to TRAM')
-    dao = Dao(os.path.join('database', 'tram.db'))
-
     with open('conf/config.yml') as c:
         config = yaml.safe_load(c)
+        dao = Dao(os.path.join('database', 'tram.db'), pool_size=config.get('db_pool_size', 4))
         conf_build = config['build']
         host = config['host']
         port = config['port']
@@ -108,12 +125,29 @@ if __name__ == '__main__':
                 attack_dict = os.path.abspath(json_file)
 
     # Start services and initiate main function
-    web_svc = WebService()
-    reg_svc = RegService(dao=dao)
-    data_svc = DataService(dao=dao, web_svc=web_svc)
-    ml_svc = MLService(web_svc=web_svc, dao=dao)
-    rest_svc = RestService(web_svc, reg_svc, data_svc, ml_svc, dao)
+    model_store = ModelStore(root=config.get('model_store', os.path.join('models', 'store')),
+                             keep=config.get('model_versions_kept', 3))
+    ml_engine = config.get('ml_engine', 'per_technique')
+    analysis_pool = WorkerPool(kind=config.get('analysis_pool', 'process'), workers=config.get('analysis_workers'),
+                               initializer=preload_models, initargs=(model_store.root, ml_engine))
+    fetcher = Fetcher(limit=config.get('fetch_connections', 20),
+                      limit_per_host=config.get('fetch_connections_per_host', 4),
+                      timeout=config.get('fetch_timeout_seconds', 30),
+                      max_bytes=config.get('fetch_max_bytes', 10485760),
+                      retries=config.get('fetch_retries', 3))
+    web_svc = WebService(pool=analysis_pool, fetcher=fetcher)
+    data_svc = DataService(dao=dao, web_svc=web_svc, board_cache_ttl=config.get('board_cache_ttl', 5))
+    reg_svc = RegService(dao=dao, data_svc=data_svc, pool=analysis_pool,
+                         min_keyword_length=config.get('keyword_min_length', 4),
+                         pattern_budget=config.get('regex_budget_seconds', 0.5),
+                         probe_timeout=config.get('regex_probe_timeout', 2.0),
+                         profile_window=config.get('regex_profile_window', 50))
+    ml_svc = MLService(web_svc=web_svc, dao=dao, data_svc=data_svc, model_store=model_store, engine=ml_engine,
+                       workers=config.get('ml_workers'), threshold=config.get('ml_threshold', 0.5),
+                       pool=analysis_pool)
+    rest_svc = RestService(web_svc, reg_svc, data_svc, ml_svc, dao, queue_workers=config.get('queue_workers', 4))
     services = dict(dao=dao, data_svc=data_svc, ml_svc=ml_svc, reg_svc=reg_svc, web_svc=web_svc, rest_svc=rest_svc)
     website_handler = WebAPI(services=services)
-    main(host, port, taxii_local=taxii_local, build=conf_build, json_file=attack_dict)
+    main(host, port, taxii_local=taxii_local, build=conf_build, json_file=attack_dict,
+         compact_interval=config.get('compact_interval_hours', 24))
 